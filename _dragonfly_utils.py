@@ -17,19 +17,37 @@ import json
 import os
 import os.path
 import platform
+import re
+import sys
 import tempfile
+import threading
+import time
+
+try:
+    import win32clipboard
+except ImportError:
+    win32clipboard = None
 
 from dragonfly import (
     ActionBase,
+    ActionError,
     DynStrActionBase,
+    Function,
     Key,
     MappingRule,
+    Mouse,
     Pause,
     Repetition,
     Sequence,
     StartApp,
     Text,
-    WaitWindow,
+)
+from dragonfly.grammar.context import (
+    AppContext,
+    Context,
+    LogicAndContext,
+    LogicNotContext,
+    LogicOrContext,
 )
 from dragonfly.windows.window import Window
 
@@ -114,12 +132,59 @@ def element_map_to_defaults(element_map):
                  if isinstance(element, tuple)])
 
 
+class CommandAction(ActionBase):
+    """Runs an action on behalf of the command spec it is mapped to, so that
+    the executor can attribute timings to the command."""
+
+    def __init__(self, spec, action):
+        super(CommandAction, self).__init__()
+        self.spec = spec
+        self.action = action
+
+    def _execute(self, data=None):
+        return self.action.execute(data)
+
+    def latency(self, data):
+        return sum(seconds for (_, seconds) in action_pauses(self.action, data))
+
+
+def unbind(action):
+    """Returns (action, data) for an action bound to extras, such as a value of
+    MappingRule: the action the BoundActions wrap and the data they pass it,
+    inner bindings taking precedence. Older dragonfly binds copies of the
+    action itself instead."""
+    data = {}
+    while hasattr(action, "_action") and hasattr(action, "_data") and \
+          not hasattr(action, "_factor"):
+        data.update(action._data or {})
+        action = action._action
+    if getattr(action, "_bound", False):
+        data.update(action._data or {})
+    return (action, data)
+
+
+def command_of(action):
+    """Returns the CommandAction action runs, or None if it was not created by
+    create_rule."""
+    (action, _) = unbind(action)
+    return action if isinstance(action, CommandAction) else None
+
+
+class EngineFunction(Function):
+    """A Function that uses the speech engine, for example to create timers,
+    so the executor runs it on the thread that receives recognitions."""
+
+    engine_thread = True
+
+
 def create_rule(name, action_map, element_map, exported=False, context=None):
     """Creates a rule with the given name, binding the given element map to the
-    action map.
+    action map. Actions are wrapped in CommandActions labelled with their spec.
     """
     return MappingRule(name,
-                       action_map,
+                       dict((spec, CommandAction(spec, action)
+                             if isinstance(action, ActionBase) else action)
+                            for (spec, action) in action_map.items()),
                        element_map_to_extras(element_map),
                        element_map_to_defaults(element_map),
                        exported,
@@ -137,6 +202,164 @@ def combine_contexts(context1, context2):
     return context1 & context2
 
 
+def executable_context(executables):
+    """Returns a context matching windows of any of the given executables."""
+    context = AppContext(executable=executables[0])
+    for executable in executables[1:]:
+        context = context | AppContext(executable=executable)
+    return context
+
+
+class FileTypeContext(Context):
+    """Matches windows whose title matches a regular expression, ignoring case.
+    Editors show the file being edited in the title, so this can match a file
+    type by its extension."""
+
+    def __init__(self, pattern):
+        Context.__init__(self)
+        self.pattern = re.compile(pattern, re.IGNORECASE)
+        self._str = pattern
+
+    def matches(self, executable, title, handle):
+        return bool(self.pattern.search(title))
+
+
+class ContextDispatcher(object):
+    """Chooses at most one of several named contexts for each window, so that
+    exactly one of the grammars using them is active. Contexts are tried in the
+    order they were added and the first match wins, so add more specific ones
+    first.
+
+    AppContexts and their &, | and ~ combinations are compiled into a shared
+    list of substring tests, each evaluated once per window; other contexts fall
+    back to their matches(). Choices are cached by window handle and title, so
+    the grammars after the first cost a dictionary lookup.
+    """
+
+    def __init__(self, cache_size=256):
+        self.cache_size = cache_size
+        self.clear()
+
+    def clear(self):
+        self.names = []
+        self.predicates = []
+        # (field, lowercase substring) of each test.
+        self.tests = []
+        self.cache = {}
+
+    def context(self, name, context):
+        """Adds context under name, returning a context which matches when
+        name is chosen."""
+        self.names.append(name)
+        self.predicates.append(self._compile(context))
+        self.cache = {}
+        return DispatchContext(self, name)
+
+    def choose(self, executable, title, handle):
+        key = (handle, title)
+        if key in self.cache:
+            return self.cache[key]
+        fields = {"executable": executable.lower(), "title": title.lower()}
+        found = [substring in fields[field] for (field, substring) in self.tests]
+        window = (executable, title, handle)
+        choice = None
+        for (name, predicate) in zip(self.names, self.predicates):
+            if predicate(found, window):
+                choice = name
+                break
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[key] = choice
+        return choice
+
+    def _test(self, field, substring):
+        test = (field, substring.lower())
+        if test not in self.tests:
+            self.tests.append(test)
+        return self.tests.index(test)
+
+    def _compile(self, context):
+        """Returns a predicate taking the test results and the window."""
+        if context is None:
+            return lambda found, window: True
+        if isinstance(context, AppContext):
+            # Each field holds a substring, or a list of them in dragonfly2.
+            fields = []
+            for (field, substrings) in (("executable", context._executable),
+                                        ("title", context._title)):
+                if substrings:
+                    if isinstance(substrings, basestring):
+                        substrings = [substrings]
+                    fields.append([self._test(field, substring)
+                                   for substring in substrings])
+            exclude = context._exclude
+            return lambda found, window: all(
+                any(found[i] for i in tests) != exclude for tests in fields)
+        if isinstance(context, LogicAndContext):
+            children = [self._compile(child) for child in context._children]
+            return lambda found, window: all(child(found, window)
+                                             for child in children)
+        if isinstance(context, LogicOrContext):
+            children = [self._compile(child) for child in context._children]
+            return lambda found, window: any(child(found, window)
+                                             for child in children)
+        if isinstance(context, LogicNotContext):
+            child = self._compile(context._child)
+            return lambda found, window: not child(found, window)
+        return lambda found, window: context.matches(*window)
+
+
+class DispatchContext(Context):
+    """Matches when its ContextDispatcher chooses name."""
+
+    def __init__(self, dispatcher, name):
+        Context.__init__(self)
+        self.dispatcher = dispatcher
+        self.name = name
+        self._str = name
+
+    def matches(self, executable, title, handle):
+        return self.dispatcher.choose(executable, title, handle) == self.name
+
+
+def benchmark_dispatch(environments=50, windows=100, repeat=20):
+    """Compares choosing among environments, one per application under a
+    context-free root, by chained exclusive contexts and by a
+    ContextDispatcher. Prints the mean time per utterance."""
+    contexts = [AppContext(title="application %d" % i) |
+                AppContext(executable="app%d.exe" % i)
+                for i in range(environments)]
+    exclusive = contexts + [reduce(combine_contexts,
+                                   [~context for context in contexts])]
+    dispatcher = ContextDispatcher()
+    dispatched = [dispatcher.context(str(i), context)
+                  for (i, context) in enumerate(contexts + [None])]
+    titles = [("C:\\Program Files\\app%d.exe" % (i * 7 % (environments * 2)),
+               "Document %d - Application %d" % (i, i * 3 % (environments * 2)),
+               i)
+              for i in range(windows)]
+
+    def time_utterances(contexts, before=None):
+        start = clock()
+        for _ in range(repeat):
+            for window in titles:
+                if before:
+                    before()
+                for context in contexts:
+                    context.matches(*window)
+        return (clock() - start) / (repeat * windows) * 1e6
+
+    print "%d environments, %d windows:" % (environments + 1, windows)
+    print "  exclusive contexts: %.1fus per utterance" % time_utterances(exclusive)
+
+    def new_window():
+        dispatcher.cache = {}
+    print "  dispatcher, new window: %.1fus per utterance" % time_utterances(
+        dispatched, new_window)
+    print "  dispatcher, cached: %.1fus per utterance" % time_utterances(
+        dispatched)
+
+
 class SwitchWindows(DynStrActionBase):
     """Simulates the effects of alt-tab. The constructor argument should be a string
     representing the number of times to effectively press the "tab" button if
@@ -146,6 +369,10 @@ class SwitchWindows(DynStrActionBase):
     def _parse_spec(self, spec):
         return int(spec)
 
+    def latency(self, data):
+        # The pause after the last tab, plus Pause("10") on Windows 8 and up.
+        return 0.25 + (0.1 if platform.release() >= "8" else 0.0)
+
     def _execute_events(self, repeat):
         if platform.release() >= "8":
             # Work around security restrictions in Windows 8.
@@ -168,8 +395,10 @@ class RunApp(ActionBase):
         self.args = args
 
     def _execute(self, data=None):
-        StartApp(*self.args).execute()
-        WaitWindow(None, os.path.basename(self.args[0]), 3).execute()
+        WaitUntil(StartApp(*self.args),
+                  window_executable(os.path.basename(self.args[0])),
+                  3000,
+                  name="RunApp").execute()
 
 
 class RunEmacs(ActionBase):
@@ -189,19 +418,216 @@ class RunEmacs(ActionBase):
         RunApp(emacs_path, "-c", "-n", cygwin_path).execute()
 
 
+# Paste chords of applications known to paste text exactly as if it were typed,
+# by executable name.
+paste_chords = {
+    "notepad": "c-v",
+    "chrome": "c-v",
+    "mintty": "s-insert",
+    "windowsterminal": "cs-v",
+}
+
+# Text at least this long is pasted rather than typed where possible.
+paste_threshold = 20
+
+
+def paste_chord(default=None):
+    """Returns the paste chord of the foreground application, or default if
+    it isn't known."""
+    foreground = Window.get_foreground()
+    if foreground.title.find("Emacs editor") != -1:
+        return "c-y"
+    executable = os.path.basename(foreground.executable).lower()
+    for (name, chord) in paste_chords.items():
+        if name in executable:
+            return chord
+    return default
+
+
 class UniversalPaste(ActionBase):
     """Paste action that works everywhere, including Emacs."""
 
     def _execute(self, data=None):
-        foreground = Window.get_foreground()
-        if foreground.title.find("Emacs editor") != -1:
-            Key("c-y").execute()
-        else:
-            Key("c-v").execute()
+        Key(paste_chord("c-v")).execute()
+
+
+if win32clipboard:
+    TEXT_FORMATS = (win32clipboard.CF_TEXT, win32clipboard.CF_OEMTEXT,
+                    win32clipboard.CF_UNICODETEXT, win32clipboard.CF_LOCALE)
+
+
+class ClipboardPaster(object):
+    """Pastes text through the clipboard, restoring the previous contents
+    restore_delay seconds later on a timer, unless something else has been
+    copied by then. Only clipboards holding nothing or plain text are used,
+    as other formats couldn't be restored. Without pywin32 nothing is
+    pasted."""
+
+    def __init__(self, restore_delay=0.5):
+        self.restore_delay = restore_delay
+        self.lock = threading.Lock()
+        # Contents to restore, as a tuple of the text or () if empty; None
+        # when no restore is pending.
+        self.saved = None
+        self.sequence = None
+        self.generation = 0
+
+    def paste(self, text, chord):
+        """Returns whether text was pasted."""
+        if not win32clipboard:
+            return False
+        with self.lock:
+            try:
+                win32clipboard.OpenClipboard()
+            except Exception:
+                return False
+            try:
+                if self.saved is None:
+                    formats = self._formats()
+                    if any(f not in TEXT_FORMATS for f in formats):
+                        return False
+                    if win32clipboard.CF_UNICODETEXT in formats:
+                        self.saved = (win32clipboard.GetClipboardData(
+                            win32clipboard.CF_UNICODETEXT),)
+                    else:
+                        self.saved = ()
+                win32clipboard.EmptyClipboard()
+                if isinstance(text, str):
+                    text = text.decode("utf-8")
+                win32clipboard.SetClipboardData(win32clipboard.CF_UNICODETEXT,
+                                                text)
+            finally:
+                win32clipboard.CloseClipboard()
+            self.sequence = win32clipboard.GetClipboardSequenceNumber()
+            self.generation += 1
+            generation = self.generation
+        Key(chord).execute()
+        timer = threading.Timer(self.restore_delay, self._restore, [generation])
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def _formats(self):
+        formats = []
+        format = win32clipboard.EnumClipboardFormats(0)
+        while format:
+            formats.append(format)
+            format = win32clipboard.EnumClipboardFormats(format)
+        return formats
+
+    def _restore(self, generation):
+        # Runs on a timer thread, so errors are caught rather than raised. The
+        # saved contents are kept after a failure, to be restored after the
+        # next paste.
+        with self.lock:
+            if generation != self.generation or self.saved is None:
+                return
+            try:
+                if win32clipboard.GetClipboardSequenceNumber() != self.sequence:
+                    # Something else has been copied since.
+                    self.saved = None
+                    return
+                win32clipboard.OpenClipboard()
+            except Exception:
+                return
+            try:
+                win32clipboard.EmptyClipboard()
+                if self.saved:
+                    win32clipboard.SetClipboardData(
+                        win32clipboard.CF_UNICODETEXT, self.saved[0])
+                self.saved = None
+            except Exception:
+                print "Failed to restore the clipboard"
+            finally:
+                try:
+                    win32clipboard.CloseClipboard()
+                except Exception:
+                    pass
+
+
+clipboard_paster = ClipboardPaster()
+
+
+def insert_text(text):
+    """Types text, or pastes it if it is at least paste_threshold characters
+    long and the foreground application pastes reliably."""
+    if len(text) >= paste_threshold:
+        chord = paste_chord()
+        if chord and clipboard_paster.paste(text, chord):
+            return
+    Text(text).execute()
+
+
+def benchmark_text_insertion(length=200):
+    """Inserts length characters by typing and then by pasting into the
+    foreground application, printing the throughput of each."""
+    text = ("abcdefghij" * (length / 10 + 1))[:length]
+    for (name, insert) in (("Typing", lambda: Text(text).execute()),
+                           ("Pasting", lambda: clipboard_paster.paste(
+                               text, paste_chord("c-v")))):
+        start = clock()
+        insert()
+        seconds = clock() - start
+        print "%s: %d characters in %.0fms, %.0f characters/s" % (
+            name, length, seconds * 1000, length / seconds)
+        Key("enter").execute()
+
+
+# Modifiers pressed by TrackedKey actions and not yet released.
+held_modifiers = set()
+
+MODIFIERS = {
+    "shift": "shift", "lshift": "lshift", "rshift": "rshift",
+    "ctrl": "ctrl", "control": "ctrl", "lctrl": "lctrl", "rctrl": "rctrl",
+    "alt": "alt", "lalt": "lalt", "ralt": "ralt",
+    "win": "win", "lwin": "lwin", "rwin": "rwin",
+}
+
+
+class TrackedKey(Key):
+    """Key action that records which modifiers it holds down or releases in
+    held_modifiers, so that ReleaseModifiers can release just those."""
+
+    def _parse_spec(self, spec):
+        transitions = []
+        for element in split_spec(spec):
+            match = re.match(r"(\w+)\s*:\s*(down|up)\b", element)
+            if match and match.group(1) in MODIFIERS:
+                transitions.append((MODIFIERS[match.group(1)],
+                                    match.group(2) == "down"))
+        return (Key._parse_spec(self, spec), transitions)
+
+    def _execute_events(self, parsed):
+        (events, transitions) = parsed
+        result = Key._execute_events(self, events)
+        for (modifier, down) in transitions:
+            if down:
+                held_modifiers.add(modifier)
+            else:
+                held_modifiers.discard(modifier)
+        return result
+
+
+class ReleaseModifiers(ActionBase):
+    """Releases the modifiers TrackedKey actions left held down, sending
+    nothing if there are none. With force, releases shift, control and alt
+    regardless."""
+
+    def __init__(self, force=False):
+        super(ReleaseModifiers, self).__init__()
+        self.force = force
+
+    def _execute(self, data=None):
+        modifiers = set(held_modifiers)
+        if self.force:
+            modifiers |= set(["shift", "ctrl", "alt"])
+        if modifiers:
+            Key(", ".join(m + ":up" for m in sorted(modifiers))).execute()
+        held_modifiers.clear()
 
 
 class FormattedText(DynStrActionBase):
-    """Types text after running through formatter function."""
+    """Inserts text after running through formatter function."""
 
     def __init__(self, spec, formatter):
         DynStrActionBase.__init__(self, spec)
@@ -211,7 +637,11 @@ class FormattedText(DynStrActionBase):
         return spec
 
     def _execute_events(self, events):
-        Text(self.formatter(events)).execute()
+        insert_text(self.formatter(events))
+
+
+def bulk_text_action(spec):
+    return FormattedText(spec, lambda text: text)
 
 
 def lowercase_text_action(spec):
@@ -245,3 +675,413 @@ def load_json(filename):
     except IOError:
         print filename + " not found"
         return None
+
+
+#-------------------------------------------------------------------------------
+# Precisely timed input.
+
+if sys.platform == "win32":
+    # time.clock is backed by QueryPerformanceCounter on Windows.
+    clock = time.clock
+    from ctypes import windll
+    winmm = windll.winmm
+else:
+    clock = time.time
+    winmm = None
+
+# Remaining time below which wait_until spins instead of sleeping.
+SPIN_SECONDS = 0.002
+# Longest sleep between checks for cancellation.
+CANCEL_INTERVAL = 0.02
+
+
+class ActionCancelled(ActionError):
+    """Raised inside a long action when the plan running it was cancelled."""
+
+
+# Set by the action executor to a function returning whether the plan running
+# on the calling thread was cancelled.
+cancel_check = None
+
+
+def check_cancelled():
+    """Raises ActionCancelled if the plan running on this thread was
+    cancelled."""
+    if cancel_check and cancel_check():
+        raise ActionCancelled("Plan cancelled")
+
+
+def interruptible_sleep(seconds):
+    """Sleeps for seconds, raising ActionCancelled as soon as the plan is
+    cancelled."""
+    deadline = clock() + seconds
+    while True:
+        check_cancelled()
+        remaining = deadline - clock()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, CANCEL_INTERVAL))
+
+
+def wait_until(deadline):
+    """Waits until clock() reaches deadline, sleeping for most of the time and
+    spinning for the last couple of milliseconds."""
+    remaining = deadline - clock()
+    if remaining > SPIN_SECONDS:
+        interruptible_sleep(remaining - SPIN_SECONDS)
+    while clock() < deadline:
+        pass
+
+
+class InterruptibleKeyboard(object):
+    """Wraps the keyboard Key sends events through, sleeping the pauses between
+    events itself so a cancelled plan stops part way. Keys still held down
+    when it stops are released."""
+
+    def __init__(self, keyboard):
+        self.keyboard = keyboard
+
+    def __getattr__(self, name):
+        return getattr(self.keyboard, name)
+
+    def send_keyboard_events(self, events):
+        # Key -> its event with the key down, for keys still held.
+        held = {}
+        batch = []
+        try:
+            for event in events:
+                check_cancelled()
+                batch.append((event[0], event[1], 0) + tuple(event[3:]))
+                if event[1]:
+                    held[event[0]] = event
+                else:
+                    held.pop(event[0], None)
+                if event[2]:
+                    self.keyboard.send_keyboard_events(batch)
+                    batch = []
+                    interruptible_sleep(event[2])
+            self.keyboard.send_keyboard_events(batch)
+        except ActionCancelled:
+            self.keyboard.send_keyboard_events(
+                [(event[0], False, 0) + tuple(event[3:])
+                 for event in held.values()])
+            raise
+
+
+if not isinstance(getattr(Key, "_keyboard", None), (type(None), InterruptibleKeyboard)):
+    Key._keyboard = InterruptibleKeyboard(Key._keyboard)
+
+
+def split_spec(spec):
+    """Splits a comma-separated action spec into its elements, ignoring commas
+    inside brackets."""
+    return [element.strip()
+            for element in re.findall(r"(?:\[[^\]]*\]|[^,])+", spec)]
+
+
+class Timeline(ActionBase):
+    """Plays input events at fixed times from the start of the action, rather
+    than pausing after each one. Steps are Mouse spec strings, whose
+    "/hundredths" pauses delay the following events; numbers, which pause for
+    that many hundredths of a second; or other actions, run as they are. A
+    trailing pause is still waited out, as it would be in a Mouse action.
+    Achieved timings of the last 100 runs are kept for
+    print_timeline_report().
+    """
+
+    timelines = []
+
+    def __init__(self, *steps):
+        super(Timeline, self).__init__()
+        self.name = " + ".join(str(step) for step in steps
+                               if isinstance(step, str))
+        self.events = []
+        self.runs = []
+        offset = 0.0
+        for step in steps:
+            if isinstance(step, (int, float)):
+                offset += step / 100.0
+            elif isinstance(step, str):
+                for element in split_spec(step):
+                    match = re.match(r"(.*?)\s*/\s*(\d+(?:\.\d+)?)$", element)
+                    self.events.append((offset, Mouse(match.group(1) if match
+                                                      else element)))
+                    if match:
+                        offset += float(match.group(2)) / 100.0
+            else:
+                self.events.append((offset, step))
+        self.duration = offset
+        Timeline.timelines.append(self)
+
+    def latency(self, data):
+        return self.duration
+
+    def _execute(self, data=None):
+        if winmm:
+            # Sleep with 1ms rather than 15.6ms granularity.
+            winmm.timeBeginPeriod(1)
+        try:
+            achieved = []
+            start = clock()
+            for offset, action in self.events:
+                wait_until(start + offset)
+                achieved.append(clock() - start)
+                action.execute(data)
+            wait_until(start + self.duration)
+            achieved.append(clock() - start)
+            self.runs = self.runs[-99:] + [achieved]
+        finally:
+            if winmm:
+                winmm.timeEndPeriod(1)
+
+
+def print_timeline_report():
+    """Prints requested and achieved event times of each Timeline that has
+    run, in milliseconds."""
+    for timeline in Timeline.timelines:
+        if not timeline.runs:
+            continue
+        print "%s (%d runs)" % (timeline.name, len(timeline.runs))
+        for i, (offset, action) in enumerate(timeline.events +
+                                             [(timeline.duration, "end")]):
+            late = [run[i] - offset for run in timeline.runs]
+            print "  %8.1f requested, %+6.2f mean, %+6.2f max  %s" % (
+                offset * 1000, sum(late) / len(late) * 1000, max(late) * 1000,
+                action)
+
+
+#-------------------------------------------------------------------------------
+# Waiting for readiness. A condition is a function called before an action runs,
+# which returns a predicate that becomes true once whatever the action triggered
+# is ready.
+
+def foreground_state():
+    window = Window.get_foreground()
+    return (window.handle, window.title)
+
+
+def window_change():
+    """Ready once the foreground window or its title changes."""
+    before = foreground_state()
+    return lambda: foreground_state() != before
+
+
+def window_executable(name):
+    """Returns a condition that is ready once the foreground window belongs to
+    an executable whose path contains name."""
+    name = name.lower()
+    return lambda: lambda: name in Window.get_foreground().executable.lower()
+
+
+def clipboard_change():
+    """Ready once anything is written to the clipboard, or at once without
+    pywin32."""
+    if not win32clipboard:
+        return lambda: True
+    before = win32clipboard.GetClipboardSequenceNumber()
+    return lambda: win32clipboard.GetClipboardSequenceNumber() != before
+
+
+class WaitUntil(ActionBase):
+    """Runs an action, then polls the condition's predicate every interval
+    seconds until it holds or timeout milliseconds have passed. How long each
+    wait took is recorded per foreground executable, for print_wait_report().
+    """
+
+    waits = []
+
+    def __init__(self, action, condition, timeout, interval=0.005, name=None):
+        super(WaitUntil, self).__init__()
+        self.action = action
+        self.condition = condition
+        self.timeout = timeout / 1000.0
+        self.interval = interval
+        self.name = name or str(action)
+        # Executable -> list of (seconds waited, whether ready).
+        self.history = {}
+        WaitUntil.waits.append(self)
+
+    def _execute(self, data=None):
+        ready = self.condition()
+        self.action.execute(data)
+        start = clock()
+        deadline = start + self.timeout
+        while not ready():
+            if clock() >= deadline:
+                self._record(clock() - start, False)
+                return
+            interruptible_sleep(self.interval)
+        self._record(clock() - start, True)
+
+    def latency(self, data):
+        # The wait itself may end immediately.
+        return sum(seconds for (_, seconds) in action_pauses(self.action, data))
+
+    def _record(self, seconds, ready):
+        executable = os.path.basename(Window.get_foreground().executable)
+        runs = self.history.setdefault(executable, [])
+        runs.append((seconds, ready))
+        del runs[:-100]
+
+
+def print_wait_report():
+    """Prints how long each WaitUntil has waited in each application."""
+    for wait in WaitUntil.waits:
+        for (executable, runs) in sorted(wait.history.items()):
+            times = sorted(seconds for (seconds, ready) in runs if ready)
+            timeouts = len(runs) - len(times)
+            if times:
+                print "%s in %s: %d waits, median %.0fms, max %.0fms, %d timed out at %.0fms" % (
+                    wait.name, executable, len(times),
+                    times[len(times) / 2] * 1000, times[-1] * 1000,
+                    timeouts, wait.timeout * 1000)
+            else:
+                print "%s in %s: all %d timed out at %.0fms" % (
+                    wait.name, executable, timeouts, wait.timeout * 1000)
+
+
+def calibrate_wait(wait, undo, repeat=10):
+    """Benchmarks wait in the foreground application by running it and then
+    undo repeat times. The timings show up in print_wait_report()."""
+    for i in range(repeat):
+        wait.execute()
+        undo.execute()
+        # Let the application settle before the next round.
+        time.sleep(0.2)
+
+
+#-------------------------------------------------------------------------------
+# Static latency audit. Computes how long the built-in pauses of an action keep
+# it busy, from the specs of its Key, Mouse, Text and Pause actions (in seconds,
+# not counting the time to send input). Actions may define latency(data) to
+# report their own pauses.
+
+KEY_ELEMENT = re.compile(r"^(?P<key>[^:/]+)(?:/(?P<inner>[\d.]+))?"
+                         r"(?::(?P<repeat>\w+))?(?:/(?P<outer>[\d.]+))?$")
+PAUSE_SUFFIX = re.compile(r"/\s*(\d+(?:\.\d+)?)$")
+
+
+class WorstCaseData(dict):
+    """Extras for formatting specs; unknown extras format as 0."""
+
+    def __missing__(self, key):
+        return 0
+
+
+def integer_range(element, depth=4):
+    """Returns (min, max) of an Integer or IntegerRef element, or None."""
+    if isinstance(getattr(element, "_min", None), int) and \
+       isinstance(getattr(element, "_max", None), int):
+        return (element._min, element._max)
+    if depth:
+        rule = getattr(element, "rule", None)
+        for child in ([rule.element] if rule else []) + list(getattr(element, "children", ())):
+            found = integer_range(child, depth - 1)
+            if found:
+                return found
+    return None
+
+
+def worst_case_data(element_map):
+    """Returns extras with each integer element at its largest value."""
+    data = WorstCaseData()
+    for (name, element) in element_map.items():
+        found = integer_range(element[0] if isinstance(element, tuple) else element)
+        if found:
+            data[name] = found[1] - 1
+    return data
+
+
+def expand_spec(action, data):
+    spec = action._spec
+    if not getattr(action, "_static", True):
+        try:
+            spec = spec % data
+        except (KeyError, TypeError, ValueError):
+            pass
+    return spec
+
+
+def action_pauses(action, data):
+    """Returns (label, seconds) for each pause in action when executed with
+    data."""
+    (action, bound) = unbind(action)
+    if bound:
+        data = WorstCaseData(data or {})
+        data.update(bound)
+    if hasattr(action, "latency"):
+        return [(getattr(action, "name", type(action).__name__),
+                 action.latency(data))]
+    if hasattr(action, "_actions"):
+        return [pause for child in action._actions
+                for pause in action_pauses(child, data)]
+    if hasattr(action, "_action") and hasattr(action, "_factor"):
+        factor = action._factor
+        count = factor.factor(data) if hasattr(factor, "factor") else factor
+        return [(label, seconds * count)
+                for (label, seconds) in action_pauses(action._action, data)]
+    if isinstance(action, Pause):
+        return [("Pause(%s)" % action._spec,
+                 float(expand_spec(action, data)) / 100)]
+    if isinstance(action, Key):
+        pauses = []
+        for element in split_spec(expand_spec(action, data)):
+            match = KEY_ELEMENT.match(element.replace(" ", ""))
+            if not match:
+                continue
+            repeat = match.group("repeat")
+            inner = float(match.group("inner") or 0) / 100
+            outer = float(match.group("outer") or 0) / 100
+            count = int(repeat) if repeat and repeat.isdigit() else 1
+            seconds = inner * max(count - 1, 0) + outer
+            if seconds:
+                pauses.append(("Key(%s)" % element, seconds))
+        return pauses
+    if isinstance(action, Mouse):
+        pauses = []
+        for element in split_spec(expand_spec(action, data)):
+            match = PAUSE_SUFFIX.search(element)
+            if match:
+                pauses.append(("Mouse(%s)" % element,
+                               float(match.group(1)) / 100))
+        return pauses
+    if isinstance(action, Text) and getattr(action, "_pause", 0):
+        text = expand_spec(action, data)
+        return [("Text pause", action._pause * len(text))]
+    return []
+
+
+def print_latency_audit(rule_maps, top=25):
+    """Prints the commands whose pauses take longest, and the pauses that add
+    the most time across commands. rule_maps is a list of (name, action map,
+    element map) triples; an action appearing in several maps is counted
+    once."""
+    commands = []
+    seen = set()
+    for (name, action_map, element_map) in rule_maps:
+        data = worst_case_data(element_map)
+        for (spec, action) in action_map.items():
+            if id(action) in seen:
+                continue
+            seen.add(id(action))
+            pauses = action_pauses(action, data)
+            total = sum(seconds for (_, seconds) in pauses)
+            if total:
+                commands.append((total, name, spec, pauses))
+    commands.sort(reverse=True)
+
+    print "Slowest of %d commands with pauses (worst case over integers):" % len(commands)
+    for (total, name, spec, pauses) in commands[:top]:
+        (label, seconds) = max(pauses, key=lambda pause: pause[1])
+        dominant = " (mostly %s)" % label if seconds > total / 2 else ""
+        print "  %6.0fms  %s: %s%s" % (total * 1000, name, spec, dominant)
+
+    budgets = {}
+    for (total, name, spec, pauses) in commands:
+        for (label, seconds) in pauses:
+            count, cost = budgets.get(label, (0, 0.0))
+            budgets[label] = (count + 1, cost + seconds)
+    print "Pauses adding the most time, summed over the commands using them:"
+    for (label, (count, cost)) in sorted(budgets.items(),
+                                         key=lambda item: -item[1][1])[:top]:
+        print "  %6.0fms  %s in %d commands" % (cost * 1000, label, count)
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Runs recognized actions on a worker thread, so that recognition callbacks
+return immediately and long action chains can be cancelled."""
+
+import Queue
+import threading
+import time
+import traceback
+
+from dragonfly import Mimic, get_engine
+
+import _dragonfly_utils as utils
+
+# Time allowed for each type of action to run, in seconds, on top of any pauses
+# in its spec and the timeout of any wait.
+type_budgets = {
+    "Key": 0.05,
+    "Mouse": 0.05,
+    "Text": 0.1,
+    "Mimic": 1.0,
+    "RunApp": 3.5,
+    "RunEmacs": 4.0,
+    "SwitchWindows": 0.5,
+}
+default_budget = 0.25
+# Time allowed for each character that text actions type, on top of the pause
+# Text sleeps after each one. FormattedText's pauses aren't counted in its
+# spec, so its allowance includes them.
+character_budgets = {
+    "Text": 0.01,
+    "FormattedText": 0.015,
+}
+
+
+def leaves(action):
+    """Returns the actions action consists of."""
+    (action, _) = utils.unbind(action)
+    if isinstance(action, utils.CommandAction):
+        return leaves(action.action)
+    if hasattr(action, "_actions"):
+        return [leaf for child in action._actions for leaf in leaves(child)]
+    if hasattr(action, "_action") and hasattr(action, "_factor"):
+        return leaves(action._action)
+    return [action]
+
+
+def needs_engine_thread(action):
+    """Returns whether action contains a Mimic or another action marked with
+    engine_thread, which have to run on the thread that receives
+    recognitions."""
+    return any(isinstance(leaf, Mimic) or getattr(leaf, "engine_thread", False)
+               for leaf in leaves(action))
+
+
+def action_budget(action):
+    """Returns how long action should take to run, in seconds, with the extras
+    it was bound to or, if unbound, the worst case. Text actions are allowed
+    time for each character, as they may be typed rather than pasted."""
+    (action, bound) = utils.unbind(action)
+    data = utils.WorstCaseData()
+    data.update(bound)
+    budget = sum(seconds for (_, seconds) in utils.action_pauses(action, data))
+    for leaf in leaves(action):
+        name = type(leaf).__name__
+        budget += (type_budgets.get(name, default_budget) +
+                   getattr(leaf, "timeout", 0))
+        if name in character_budgets:
+            budget += character_budgets[name] * len(utils.expand_spec(leaf, data))
+    return budget
+
+
+def action_label(action):
+    """Returns the spec of the command action runs, or else a description."""
+    command = utils.command_of(action)
+    return command.spec if command else str(action)[:60]
+
+
+class ActionExecutor(object):
+    """Executes plans, lists of actions, in order on a worker thread. At most
+    max_pending plans wait in the queue; further ones are dropped. cancel()
+    stops the running plan before its next action and drops waiting ones. The
+    cleanup action runs after a plan is cancelled or fails part way.
+
+    A watchdog logs actions that overrun their action_budget(), counting them
+    per command, and aborts the rest of their plan if abort_on_overrun is set.
+    If an action is still running stall_limit seconds past its budget, its
+    worker is abandoned and a new one carries on with the queue.
+
+    Actions for which needs_engine_thread() holds are handed to an engine
+    timer, and the worker waits for them to run. A plan that needs it is run straight away on
+    the calling thread if nothing is queued or running. Pauses in Key,
+    Timeline and WaitUntil check utils.check_cancelled(), so cancel() also
+    stops the running action part way.
+
+    Plans are run through profiler.run(), if given, so that a
+    _metrics_utils.SessionProfiler can cover the worker threads.
+    """
+
+    def __init__(self, max_pending=8, cleanup=None, abort_on_overrun=False,
+                 stall_limit=5.0, profiler=None):
+        self.plans = Queue.Queue(max_pending)
+        self.cleanup = cleanup
+        self.profiler = profiler
+        self.abort_on_overrun = abort_on_overrun
+        self.stall_limit = stall_limit
+        self.generation = 0
+        self.worker = 0
+        self.thread = None
+        # (label, start, budget, worker) of the running action.
+        self.current = None
+        self.watchdog = None
+        self.engine_timer = None
+        # (action, generation, worker, done event) to run on the engine thread.
+        self.engine_actions = Queue.Queue()
+        # The (generation, worker) of the plan running on each thread.
+        self.local = threading.local()
+        # Command label -> (overruns, worst overrun in seconds).
+        self.overruns = {}
+        # Metrics.
+        self.submitted = 0
+        self.dropped = 0
+        self.cancelled = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_run = 0.0
+        self.max_run = 0.0
+        self.completed = 0
+
+    def start(self):
+        if self.thread:
+            return
+        utils.cancel_check = self._cancelled
+        self.engine_timer = get_engine().create_timer(self._run_engine_actions,
+                                                      0.05)
+        self._spawn()
+        self.watchdog = threading.Thread(target=self._watch,
+                                         name="Action watchdog")
+        self.watchdog.daemon = True
+        self.watchdog.start()
+
+    def stop(self):
+        if self.thread:
+            self.cancel()
+            self.plans.put(None)
+            self.thread.join(5)
+            self.thread = None
+            self.watchdog.join(1)
+            self.watchdog = None
+            self.engine_timer.stop()
+            self.engine_timer = None
+            utils.cancel_check = None
+
+    def submit(self, plan, recording=None):
+        """Queues plan and returns immediately, unless it needs the engine
+        thread and the executor is idle. If given, recording (a
+        _metrics_utils.Recording) is stamped as the plan runs."""
+        self.submitted += 1
+        if recording:
+            recording.stage("queued")
+        if not self.plans.unfinished_tasks and \
+           any(needs_engine_thread(action) for action in plan):
+            self._execute(plan, time.time(), self.generation, recording, None)
+            return
+        depth = self.plans.qsize() + 1
+        self.max_depth = max(self.max_depth, depth)
+        try:
+            self.plans.put_nowait((plan, time.time(), self.generation, recording))
+        except Queue.Full:
+            self.dropped += 1
+            if recording:
+                recording.abandon()
+            print("Dropped plan, %d already waiting." % self.plans.qsize())
+
+    def cancel(self):
+        self.generation += 1
+        while True:
+            try:
+                (_, _, _, recording) = self.plans.get_nowait()
+            except Queue.Empty:
+                break
+            self.cancelled += 1
+            if recording:
+                recording.abandon()
+            self.plans.task_done()
+
+    def print_metrics(self):
+        print("Plans: %d submitted, %d completed, %d dropped, %d cancelled; "
+              "queue depth %d now, %d max" %
+              (self.submitted, self.completed, self.dropped, self.cancelled,
+               self.plans.qsize(), self.max_depth))
+        if self.completed:
+            print("Waited %.1fms mean, %.1fms max; ran %.1fms mean, %.1fms max" %
+                  (self.total_wait / self.completed * 1000, self.max_wait * 1000,
+                   self.total_run / self.completed * 1000, self.max_run * 1000))
+        for (label, (count, worst)) in sorted(self.overruns.items(),
+                                              key=lambda item: -item[1][0]):
+            print("  %s: %d overruns, worst by %.0fms" % (label, count,
+                                                          worst * 1000))
+
+    def _spawn(self):
+        self.worker += 1
+        self.thread = threading.Thread(target=self._run, args=(self.worker,),
+                                       name="Action executor %d" % self.worker)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, worker):
+        while worker == self.worker:
+            item = self.plans.get()
+            try:
+                if item is None:
+                    return
+                if self.profiler:
+                    self.profiler.run(self._execute, *(item + (worker,)))
+                else:
+                    self._execute(*(item + (worker,)))
+            finally:
+                # An abandoned worker's item was already marked done.
+                if worker == self.worker:
+                    self.plans.task_done()
+
+    def _watch(self):
+        reported = None
+        while self.thread:
+            time.sleep(0.05)
+            current = self.current
+            if not current:
+                continue
+            (label, start, budget, worker) = current
+            late = time.time() - start - budget
+            if late > 0 and current is not reported:
+                print("Action still running %.0fms past its %.0fms budget: %s" %
+                      (late * 1000, budget * 1000, label))
+                reported = current
+            if late > self.stall_limit and worker == self.worker:
+                print("Abandoning stalled worker.")
+                self.current = None
+                self.plans.task_done()
+                self._spawn()
+                self._cleanup()
+
+    def _run_engine_actions(self):
+        while True:
+            try:
+                (action, generation, worker, done) = self.engine_actions.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                if not self._stale(generation, worker):
+                    self.local.plan = (generation, worker)
+                    action.execute()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.local.plan = None
+                done.set()
+
+    def _stale(self, generation, worker):
+        """Returns whether a plan was cancelled or its worker abandoned."""
+        return generation != self.generation or \
+            bool(worker and worker != self.worker)
+
+    def _cancelled(self):
+        plan = getattr(self.local, "plan", None)
+        return bool(plan) and self._stale(*plan)
+
+    def _execute(self, plan, submitted, generation, recording, worker):
+        start = time.time()
+        if recording:
+            recording.stage("started")
+        self.local.plan = (generation, worker)
+        try:
+            for action in plan:
+                if self._stale(generation, worker):
+                    break
+                if not self._run_action(action, generation, worker, recording):
+                    self._abort(recording)
+                    return
+            if self._stale(generation, worker):
+                self.cancelled += 1
+                self._abort(recording)
+                return
+        except Exception:
+            traceback.print_exc()
+            self._abort(recording)
+            return
+        finally:
+            self.local.plan = None
+        end = time.time()
+        if recording:
+            recording.finish()
+        self.completed += 1
+        self.total_wait += start - submitted
+        self.max_wait = max(self.max_wait, start - submitted)
+        self.total_run += end - start
+        self.max_run = max(self.max_run, end - start)
+
+    def _run_action(self, action, generation, worker, recording):
+        """Runs action; returns whether the plan should continue."""
+        label = action_label(action)
+        budget = action_budget(action)
+        start = time.time()
+        current = self.current = (label, start, budget, worker)
+        if recording:
+            command = utils.command_of(action)
+            recording.begin_action(command.spec if command else None)
+        try:
+            self._perform(action, generation, worker)
+            if recording:
+                recording.end_action()
+        finally:
+            # Leave a replacement worker's action alone.
+            if self.current is current:
+                self.current = None
+        late = time.time() - start - budget
+        if late <= 0:
+            return True
+        (count, worst) = self.overruns.get(label, (0, 0.0))
+        self.overruns[label] = (count + 1, max(worst, late))
+        print("Action overran its %.0fms budget by %.0fms: %s" %
+              (budget * 1000, late * 1000, label))
+        return not self.abort_on_overrun
+
+    def _perform(self, action, generation, worker):
+        """Runs action, on the engine thread if it needs it and this is a
+        worker."""
+        if not worker or not needs_engine_thread(action):
+            action.execute()
+            return
+        done = threading.Event()
+        self.engine_actions.put((action, generation, worker, done))
+        while not done.wait(0.05):
+            if self._stale(generation, worker):
+                return
+
+    def _abort(self, recording):
+        if recording:
+            recording.abandon()
+        self._cleanup()
+
+    def _cleanup(self):
+        if self.cleanup:
+            try:
+                self.cleanup.execute()
+            except Exception:
+                traceback.print_exc()
@@ -2,42 +2,453 @@
 # (c) Copyright 2015 by James Stout
 # Licensed under the LGPL, see <http://www.gnu.org/licenses/>
 
-"""Eye tracker functions."""
+"""Eye tracker functions.
 
+Positions come from a backend: a recorded trace replayed in real time if the
+EYE_TRACKER_TRACE environment variable names a trace file (see
+_gaze_utils.load_trace), otherwise gaze_service.py if it is running, otherwise
+the Tobii EyeX DLLs loaded into this process.
+
+The backend is created and connected by a supervisor thread once connect() is
+called, and reconnected with backoff if it stops responding. While it is down,
+gaze functions raise TrackerUnavailable instead of blocking.
+"""
+
+from bisect import bisect_right
 from ctypes import (byref, c_double, CDLL)
-import win32gui
+import os
+import threading
+import time
+
+try:
+    import win32gui
+except ImportError:
+    win32gui = None
 
-from dragonfly import (Mouse, Text)
+from dragonfly import (Mouse, Text, get_engine, monitors)
+import gaze_service
 # import _dragonfly_local as local
 
+try:
+    import numpy
+    import _gaze_utils as gaze
+except ImportError:
+    numpy = None
+
 DLL_DIRECTORY = "C:/Program Files (x86)/Tobii/Tobii EyeX"
 
-# Attempt to load eye tracker DLLs.
-try:
-    eyex_dll = CDLL(DLL_DIRECTORY + "/Tobii.EyeX.Client.dll")
-    tracker_dll = CDLL(DLL_DIRECTORY + "/Tracker.dll")
-except:
-    print("Tracker not loaded.")
 
 
-def connect():
+class TrackerUnavailable(Exception):
+    pass
+
+
+class TrackerBackend(object):
+    """Source of gaze positions. connect() and disconnect() return a status
+    code, zero meaning success. check() raises if the backend stopped
+    working."""
+
+    def check(self):
+        self.last_position()
+
+    def connect(self):
+        return 0
+
+    def disconnect(self):
+        return 0
+
+    def last_position(self):
+        raise NotImplementedError()
+
+    def activate(self):
+        pass
+
+    def panning_step(self):
+        pass
+
+
+class DllBackend(TrackerBackend):
+    """The Tobii EyeX tracker, through Tracker.dll. The DLL keeps returning its
+    last position after the tracker drops. Builds of the DLL that export
+    last_timestamp(), the time of the newest sample, are checked for that
+    advancing: check() fails once it hasn't for max_age seconds, long enough
+    to span blinks and glances away from the screen. An unchanged position
+    says nothing, as it also holds while the eyes are closed, so older builds
+    are only checked for answering."""
+
+    def __init__(self, directory=DLL_DIRECTORY, max_age=10.0):
+        self.eyex_dll = CDLL(directory + "/Tobii.EyeX.Client.dll")
+        self.tracker_dll = CDLL(directory + "/Tracker.dll")
+        try:
+            self.last_timestamp = self.tracker_dll.last_timestamp
+            self.last_timestamp.restype = c_double
+        except AttributeError:
+            self.last_timestamp = None
+        self.max_age = max_age
+        self.previous = None
+        self.advanced = None
+
+    def connect(self):
+        self.previous = None
+        self.advanced = time.time()
+        return self.tracker_dll.connect()
+
+    def check(self):
+        self.last_position()
+        if self.last_timestamp is None:
+            return
+        timestamp = self.last_timestamp()
+        now = time.time()
+        if timestamp != self.previous:
+            self.previous = timestamp
+            self.advanced = now
+        elif now - self.advanced > self.max_age:
+            raise IOError("Tracker timestamp stopped advancing.")
+
+    def disconnect(self):
+        return self.tracker_dll.disconnect()
+
+    def last_position(self):
+        x = c_double()
+        y = c_double()
+        self.tracker_dll.last_position(byref(x), byref(y))
+        return (x.value, y.value)
+
+    def activate(self):
+        self.tracker_dll.activate()
+
+    def panning_step(self):
+        self.tracker_dll.panning_step()
+
+
+class ReplayBackend(TrackerBackend):
+    """Replays a trace of (timestamp, x, y) samples, or the path of a file
+    holding one, starting at connect(). speed scales playback; after the last
+    sample the trace either loops or holds its final position. Activations and
+    panning steps are recorded in actions."""
+
+    def __init__(self, trace, speed=1.0, loop=False):
+        if isinstance(trace, basestring):
+            if numpy is None:
+                raise ImportError("Loading a gaze trace requires numpy.")
+            trace = gaze.load_trace(trace)
+        self.times = [float(sample[0]) for sample in trace]
+        self.positions = [(float(sample[1]), float(sample[2]))
+                          for sample in trace]
+        self.speed = speed
+        self.loop = loop
+        self.started = None
+        self.actions = []
+
+    def connect(self):
+        self.started = time.time()
+        return 0
+
+    def disconnect(self):
+        self.started = None
+        return 0
+
+    def last_position(self):
+        if self.started is None:
+            return self.positions[0]
+        elapsed = (time.time() - self.started) * self.speed
+        length = self.times[-1] - self.times[0]
+        if self.loop and length > 0:
+            elapsed %= length
+        index = bisect_right(self.times, self.times[0] + elapsed) - 1
+        return self.positions[max(0, index)]
+
+    def activate(self):
+        self.actions.append((time.time(), "activate", self.last_position()))
+
+    def panning_step(self):
+        self.actions.append((time.time(), "panning_step",
+                             self.last_position()))
+
+
+class SharedMemoryBackend(TrackerBackend):
+    """Reads the samples gaze_service.py publishes. connect() fails and
+    last_position() raises TrackerUnavailable unless the service has published
+    a sample within max_age seconds, so a dead service shows as disconnected."""
+
+    def __init__(self, path=gaze_service.DEFAULT_PATH, max_age=1.0):
+        self.path = path
+        self.max_age = max_age
+        self.reader = None
+
+    def connect(self):
+        if not self.reader:
+            self.reader = gaze_service.GazeReader(self.path)
+        sample = self.reader.latest()
+        if not sample or time.time() - sample[0] > self.max_age:
+            return 1
+        return 0
+
+    def disconnect(self):
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+        return 0
+
+    def last_position(self):
+        sample = self.reader.latest()
+        if not sample or time.time() - sample[0] > self.max_age:
+            raise TrackerUnavailable("Gaze service stopped publishing.")
+        return sample[1:]
+
+    def activate(self):
+        self.reader.request(activate=True)
+
+    def panning_step(self):
+        self.reader.request(panning_step=True)
+
+
+def service_running():
+    service = SharedMemoryBackend()
     try:
-        result = tracker_dll.connect()
-        print("connect: %d" % result)
-    except:
-        print("Could not connect to tracker.")
+        return service.connect() == 0
+    except (IOError, OSError, ValueError):
+        return False
+    finally:
+        service.disconnect()
+
+
+def create_backend():
+    """Returns the trace, gaze service or eye tracker DLL backend."""
+    if os.environ.get("EYE_TRACKER_TRACE"):
+        return ReplayBackend(os.environ["EYE_TRACKER_TRACE"])
+    elif service_running():
+        return SharedMemoryBackend()
+    else:
+        return DllBackend()
+
+
+backend = None
+
+
+class GazeSampler(object):
+    """Polls the tracker on a background thread into a fixed-size ring buffer
+    and serves a smoothed position over the most recent samples. Samples are
+    also passed to a fixation detector, in chunks of half the buffer."""
+
+    def __init__(self, rate=60, window=12, max_age=0.25, threshold=3.0,
+                 detector=None, fixation_age=0.5):
+        self.interval = 1.0 / rate
+        self.max_age = max_age
+        self.threshold = threshold
+        self.detector = detector
+        self.fixation_age = fixation_age
+        # Rows of (timestamp, x, y), written round-robin.
+        self.samples = numpy.zeros((window, 3))
+        self.count = 0
+        self.fed = 0
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="Gaze sampler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(1)
+            self.thread = None
+
+    def add(self, timestamp, x, y):
+        with self.lock:
+            self.samples[self.count % len(self.samples)] = (timestamp, x, y)
+            self.count += 1
+            if self.detector and self.count - self.fed >= len(self.samples) // 2:
+                self._feed()
+
+    def fixation(self):
+        """Returns the centroid of the current fixation, or of the last one if
+        it ended within fixation_age seconds, or None."""
+        if not self.detector:
+            return None
+        with self.lock:
+            self._feed()
+            return self.detector.centroid(time.time() - self.fixation_age)
+
+    def position(self):
+        """Returns the median-filtered position of the samples taken in the
+        last max_age seconds, ignoring samples far from the median, or None
+        if there are no recent samples."""
+        with self.lock:
+            samples = self.samples[:min(self.count, len(self.samples))].copy()
+        points = samples[samples[:, 0] >= time.time() - self.max_age, 1:]
+        if not len(points):
+            return None
+        median = numpy.median(points, axis=0)
+        distances = numpy.hypot(*(points - median).T)
+        # The extra pixel keeps the median itself when all samples agree.
+        limit = self.threshold * numpy.median(distances) + 1
+        return tuple(points[distances <= limit].mean(axis=0))
+
+    def _feed(self):
+        # Called with the lock held.
+        size = len(self.samples)
+        new = min(self.count - self.fed, size)
+        if new:
+            indices = numpy.arange(self.count - new, self.count) % size
+            self.detector.feed(self.samples[indices])
+        self.fed = self.count
+
+    def _run(self):
+        while self.running:
+            try:
+                x, y = get_position()
+            except Exception:
+                # Tracker went away; keep polling in case it comes back.
+                pass
+            else:
+                self.add(time.time(), x, y)
+            time.sleep(self.interval)
+
+
+# Smoothing requires NumPy; without it positions come straight from the DLL.
+sampler = (GazeSampler(detector=gaze.VelocityFixationDetector())
+           if numpy else None)
+
+
+class ConnectionSupervisor(object):
+    """Connects to the backend on a background thread, checks it every
+    heartbeat seconds and reconnects after failures, waiting twice as long
+    after each consecutive failure up to max_backoff seconds. lock is held
+    while the thread uses the backend."""
+
+    def __init__(self, heartbeat=1.0, min_backoff=1.0, max_backoff=60.0):
+        self.heartbeat = heartbeat
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.connected = False
+        self.status = "Not started."
+        self.running = False
+        self.thread = None
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Starts supervising, or retries immediately if already started."""
+        self.wake.set()
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run,
+                                       name="Eye tracker supervisor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        if self.thread:
+            self.thread.join(5)
+            self.thread = None
+
+    def _run(self):
+        global backend
+        backoff = self.min_backoff
+        while self.running:
+            self.wake.clear()
+            try:
+                with self.lock:
+                    if not self.connected:
+                        if not backend:
+                            backend = create_backend()
+                        result = backend.connect()
+                        if result:
+                            raise IOError("connect returned %d." % result)
+                        self._set_connected(True, "Connected to %s." %
+                                            type(backend).__name__)
+                    else:
+                        backend.check()
+                backoff = self.min_backoff
+                self.wake.wait(self.heartbeat)
+            except Exception as e:
+                with self.lock:
+                    if self.connected:
+                        self._disconnect()
+                    self._set_connected(False, "Disconnected (%s), retrying "
+                                        "in %ds." % (e, backoff))
+                self.wake.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+        with self.lock:
+            if self.connected:
+                self._disconnect()
+            self._set_connected(False, "Stopped.")
+
+    def _set_connected(self, connected, status):
+        if status != self.status:
+            print("Eye tracker: " + status)
+        self.connected = connected
+        self.status = status
+        if sampler:
+            if connected:
+                sampler.start()
+            else:
+                sampler.stop()
+
+    def _disconnect(self):
+        try:
+            backend.disconnect()
+        except Exception:
+            pass
+
+
+supervisor = ConnectionSupervisor()
+
+
+def set_backend(new_backend):
+    """Switches to another backend; the supervisor connects to it."""
+    global backend
+    with supervisor.lock:
+        old_backend, backend = backend, new_backend
+        if old_backend and supervisor.connected:
+            old_backend.disconnect()
+        supervisor._set_connected(False, "Switching to %s." %
+                                  type(new_backend).__name__)
+    supervisor.start()
+
+
+def connect():
+    supervisor.start()
 
 
 def disconnect():
-    result = tracker_dll.disconnect()
-    print("disconnect: %d" % result)
+    supervisor.stop()
+
+
+def print_status():
+    print("Eye tracker: " + supervisor.status)
+
+
+def require_connection():
+    if not supervisor.connected:
+        raise TrackerUnavailable(supervisor.status)
 
 
 def get_position():
-    x = c_double()
-    y = c_double()
-    tracker_dll.last_position(byref(x), byref(y))
-    return (x.value, y.value)
+    require_connection()
+    return backend.last_position()
+
+
+def get_filtered_position():
+    """Returns the current or just-ended fixation, falling back to the smoothed
+    gaze position and then to the last raw sample if the sampler isn't
+    running."""
+    require_connection()
+    if sampler:
+        position = sampler.fixation() or sampler.position()
+        if position:
+            return position
+    return get_position()
 
 
 def screen_to_foreground(position):
@@ -49,7 +460,7 @@ def print_position():
 
 
 def move_to_position(offset=(0, 0)):
-    position = get_position()
+    position = get_filtered_position()
     x = max(0, int(position[0]) + offset[0])
     y = max(0, int(position[1]) + offset[1])
     print("Moving to [%d, %d]" % (x, y))
@@ -57,13 +468,96 @@ def move_to_position(offset=(0, 0)):
 
 
 def type_position(format):
-    position = get_position()
+    position = get_filtered_position()
     Text(format % (position[0], position[1])).execute()
 
 
 def activate_position():
-    tracker_dll.activate()
+    require_connection()
+    backend.activate()
 
 
 def panning_step_position():
-    tracker_dll.panning_step()
+    require_connection()
+    backend.panning_step()
+
+
+class GazeScroller(object):
+    """Scrolls on an engine timer until stopped, at up to max_speed notches per
+    second depending on how far the gaze is above or below the middle of the
+    screen. Without a fixed direction, looking above the middle scrolls up and
+    below scrolls down, pausing within the dead zone; with one, scrolling
+    continues at min_speed or faster wherever the gaze is. Each tick sends
+    the whole notches accumulated so far as a single event."""
+
+    def __init__(self, interval=0.05, max_speed=40.0, min_speed=4.0,
+                 dead_zone=0.15):
+        self.interval = interval
+        self.max_speed = max_speed
+        self.min_speed = min_speed
+        self.dead_zone = dead_zone
+        self.direction = None
+        self.scale = 1.0
+        self.pending = 0.0
+        self.last_tick = None
+        self.timer = None
+
+    def start(self, direction=None, scale=1.0):
+        """Starts scrolling, or changes direction and scale if already
+        scrolling. direction is 1 for up, -1 for down or None to follow the
+        gaze."""
+        # Scroll events go to the window under the mouse.
+        move_to_position()
+        screen = monitors[0].rectangle
+        self.middle = screen.y + screen.dy / 2.0
+        self.half_height = screen.dy / 2.0
+        self.direction = direction
+        self.scale = scale
+        self.pending = 0.0
+        self.last_tick = time.time()
+        if not self.timer:
+            self.timer = get_engine().create_timer(self._tick, self.interval)
+
+    def stop(self):
+        if self.timer:
+            self.timer.stop()
+            self.timer = None
+
+    def speed(self, y):
+        """Returns notches per second to scroll up (negative for down) when the
+        gaze is at height y."""
+        offset = (self.middle - y) / self.half_height
+        distance = min(1.0, max(0.0, (abs(offset) - self.dead_zone) /
+                                (1 - self.dead_zone)))
+        if self.direction:
+            speed = self.min_speed + (self.max_speed - self.min_speed) * distance ** 2
+            return self.direction * self.scale * speed
+        if not distance:
+            return 0.0
+        return (1 if offset > 0 else -1) * self.scale * self.max_speed * distance ** 2
+
+    def _tick(self):
+        try:
+            position = get_filtered_position()
+        except TrackerUnavailable:
+            self.stop()
+            return
+        now = time.time()
+        self.pending += self.speed(position[1]) * (now - self.last_tick)
+        self.last_tick = now
+        notches = int(self.pending)
+        if notches:
+            self.pending -= notches
+            Mouse("%s:%d" % ("scrollup" if notches > 0 else "scrolldown",
+                             abs(notches))).execute()
+
+
+scroller = GazeScroller()
+
+
+def start_scrolling(direction=None, scale=1.0):
+    scroller.start(direction, scale)
+
+
+def stop_scrolling():
+    scroller.stop()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Gaze sample processing that doesn't depend on the tracker or dragonfly.
+
+Samples are rows of (timestamp in seconds, x, y). Run this module directly to
+benchmark the fixation detectors on a recorded trace:
+
+    python _gaze_utils.py [trace file] [chunk size]
+
+Without a trace file a synthetic one is generated.
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+
+import numpy
+
+
+def as_samples(samples):
+    return numpy.asarray(samples, dtype=float).reshape(-1, 3)
+
+
+class Fixation(object):
+    """A run of samples the eye stayed on, summarized incrementally."""
+
+    def __init__(self, samples):
+        self.start = samples[0, 0]
+        self.end = samples[0, 0]
+        self.total = numpy.zeros(2)
+        self.count = 0
+        self.low = samples[0, 1:].copy()
+        self.high = samples[0, 1:].copy()
+        self.extend(samples)
+
+    def extend(self, samples):
+        points = samples[:, 1:]
+        self.end = samples[-1, 0]
+        self.total += points.sum(axis=0)
+        self.count += len(points)
+        numpy.minimum(self.low, points.min(axis=0), out=self.low)
+        numpy.maximum(self.high, points.max(axis=0), out=self.high)
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    @property
+    def centroid(self):
+        return tuple(self.total / self.count)
+
+
+class FixationDetector(object):
+    """Base class for streaming fixation detectors. Subclasses implement feed(),
+    calling _extend() with runs of fixation samples and _break() when a
+    fixation ends."""
+
+    def __init__(self, min_duration):
+        self.min_duration = min_duration
+        self.current = None
+        self.last = None
+
+    def feed(self, samples):
+        raise NotImplementedError()
+
+    def fixation(self):
+        """Returns the fixation in progress if it has lasted long enough,
+        otherwise the last completed one, or None."""
+        if self.current and self.current.duration >= self.min_duration:
+            return self.current
+        return self.last
+
+    def centroid(self, since=None):
+        """Returns the centroid of fixation(), or None if there isn't one or
+        it ended before since."""
+        fixation = self.fixation()
+        if not fixation or (since is not None and fixation.end < since):
+            return None
+        return fixation.centroid
+
+    def _extend(self, samples):
+        if self.current:
+            self.current.extend(samples)
+        else:
+            self.current = Fixation(samples)
+
+    def _break(self):
+        if self.current and self.current.duration >= self.min_duration:
+            self.last = self.current
+        self.current = None
+
+
+class VelocityFixationDetector(FixationDetector):
+    """I-VT: samples moving slower than threshold pixels per second belong to a
+    fixation."""
+
+    def __init__(self, threshold=1000.0, min_duration=0.1):
+        FixationDetector.__init__(self, min_duration)
+        self.threshold = threshold
+        self.previous = None
+
+    def feed(self, samples):
+        samples = as_samples(samples)
+        if not len(samples):
+            return
+        previous = samples[:1] if self.previous is None else self.previous
+        self.previous = samples[-1:].copy()
+        deltas = numpy.diff(numpy.vstack((previous, samples)), axis=0)
+        speeds = (numpy.hypot(deltas[:, 1], deltas[:, 2]) /
+                  numpy.maximum(deltas[:, 0], 1e-6))
+        slow = speeds < self.threshold
+        edges = numpy.flatnonzero(slow[1:] != slow[:-1]) + 1
+        for start, end in zip(numpy.concatenate(([0], edges)),
+                              numpy.concatenate((edges, [len(samples)]))):
+            if slow[start]:
+                self._extend(samples[start:end])
+            else:
+                self._break()
+
+
+class DispersionFixationDetector(FixationDetector):
+    """I-DT: samples belong to a fixation while the fixation's dispersion (width
+    plus height of its bounding box) stays within threshold pixels."""
+
+    def __init__(self, threshold=50.0, min_duration=0.1):
+        FixationDetector.__init__(self, min_duration)
+        self.threshold = threshold
+
+    def feed(self, samples):
+        samples = as_samples(samples)
+        i = 0
+        while i < len(samples):
+            if not self.current:
+                self._extend(samples[i:i + 1])
+                i += 1
+                continue
+            points = samples[i:, 1:]
+            low = numpy.minimum.accumulate(
+                numpy.vstack((self.current.low, points)))[1:]
+            high = numpy.maximum.accumulate(
+                numpy.vstack((self.current.high, points)))[1:]
+            over = numpy.flatnonzero((high - low).sum(axis=1) > self.threshold)
+            stop = over[0] if len(over) else len(points)
+            if stop:
+                self._extend(samples[i:i + stop])
+            i += stop
+            if len(over):
+                self._break()
+
+
+def load_trace(path):
+    """Loads samples from a text file with one "timestamp x y" row per line,
+    separated by whitespace or commas. Lines starting with # are ignored."""
+    with open(path) as f:
+        rows = [line.replace(",", " ").split() for line in f
+                if line.strip() and not line.startswith("#")]
+    return as_samples([[float(value) for value in row[:3]] for row in rows])
+
+
+def synthetic_trace(seconds=60.0, rate=60, seed=0):
+    """Generates fixations of 150-600ms joined by 30ms saccades, with 5 pixels
+    of noise, on a 1920x1080 screen."""
+    random = numpy.random.RandomState(seed)
+    times = numpy.arange(0, seconds, 1.0 / rate)
+    points = numpy.empty((len(times), 2))
+    target = random.uniform((0, 0), (1920, 1080))
+    i = 0
+    while i < len(times):
+        fixation = int(random.uniform(0.15, 0.6) * rate)
+        points[i:i + fixation] = target
+        i += fixation
+        source, target = target, random.uniform((0, 0), (1920, 1080))
+        saccade = max(1, int(0.03 * rate))
+        steps = numpy.linspace(0, 1, saccade + 2)[1:-1, None]
+        points[i:i + saccade] = (source + (target - source) * steps)[:len(points) - i]
+        i += saccade
+    points += random.normal(0, 5, points.shape)
+    return numpy.column_stack((times, points))
+
+
+def benchmark(detector, samples, chunk_size):
+    """Feeds samples to detector in chunks. Returns the CPU time per sample and
+    the delays, in trace time, between each fixation starting and the detector
+    reporting it."""
+    clock = getattr(time, "process_time", None) or time.clock
+    delays = []
+    reported = None
+    cpu = 0.0
+    for i in range(0, len(samples), chunk_size):
+        chunk = samples[i:i + chunk_size]
+        start = clock()
+        detector.feed(chunk)
+        cpu += clock() - start
+        fixation = detector.fixation()
+        if fixation and fixation is not reported:
+            delays.append(chunk[-1, 0] - fixation.start)
+            reported = fixation
+    return cpu / max(1, len(samples)), numpy.array(delays)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        trace = load_trace(sys.argv[1])
+    else:
+        trace = synthetic_trace()
+    chunk_size = int(sys.argv[2]) if len(sys.argv) > 2 else 6
+    print("%d samples over %.1fs, chunks of %d" %
+          (len(trace), trace[-1, 0] - trace[0, 0], chunk_size))
+    for detector in (VelocityFixationDetector(), DispersionFixationDetector()):
+        cpu, delays = benchmark(detector, trace, chunk_size)
+        if not len(delays):
+            delays = numpy.zeros(1)
+        print("%s: %.1fus CPU per sample, %d fixations, "
+              "latency median %.0fms, 95th percentile %.0fms" %
+              (type(detector).__name__, cpu * 1e6, len(delays),
+               numpy.median(delays) * 1e3, numpy.percentile(delays, 95) * 1e3))
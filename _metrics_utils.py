@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Latency of the recognition path, from the grammar callback until the last
+action of the utterance has run, a profiler for it, and counts of how often
+each command is spoken.
+
+Each utterance gets a Recording from LatencyMetrics.start(), stamped as it
+passes through the callback, the executor and each action. Finished
+recordings are folded into histograms per environment stage and per command,
+which print_report() prints and write() saves as JSON.
+
+While a SessionProfiler is started, calls made through its run() are profiled
+with cProfile, one profile per thread, and merged into a report sorted by
+cumulative time when it is stopped.
+
+UsageCounts persists how often each command spec was spoken, so that grammars
+can be built with rarely used commands moved out of the repeated sequence.
+
+Files are written to DIRECTORY, in the user's application data rather than
+the NatLink macro folder.
+"""
+
+import cProfile
+import json
+import math
+import os
+import os.path
+import pstats
+import sys
+import threading
+
+import _dragonfly_utils as utils
+
+DIRECTORY = (os.path.join(os.environ["APPDATA"], "dragoncode")
+             if os.environ.get("APPDATA")
+             else os.path.expanduser(os.path.join("~", ".dragoncode")))
+DEFAULT_PATH = os.path.join(DIRECTORY, "latency_metrics.json")
+PROFILE_PATH = os.path.join(DIRECTORY, "recognition_profile")
+USAGE_PATH = os.path.join(DIRECTORY, "command_usage.json")
+
+# Histogram buckets start at FLOOR seconds, each RATIO times wider than the last.
+FLOOR = 1e-5
+RATIO = 2 ** 0.25
+LOG_RATIO = math.log(RATIO)
+
+# Stages of an utterance, in order.
+STAGES = ["callback", "decoded", "queued", "started", "done", "total"]
+
+
+def make_parent(path):
+    """Creates the folder path will be written in, if missing."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+
+class Histogram(object):
+    """Counts durations in logarithmic buckets, so percentiles are accurate to
+    within a bucket width (19%) whatever the scale."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        bucket = int(math.log(seconds / FLOOR) / LOG_RATIO) if seconds > FLOOR else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket holding the given percentile."""
+        target = self.count * percent / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min(FLOOR * RATIO ** (bucket + 1), self.max)
+        return self.max
+
+    def summary(self):
+        """Returns the statistics in milliseconds, with the raw buckets."""
+        return {"count": self.count,
+                "mean": self.total / max(1, self.count) * 1000,
+                "p50": self.percentile(50) * 1000,
+                "p95": self.percentile(95) * 1000,
+                "p99": self.percentile(99) * 1000,
+                "max": self.max * 1000,
+                "buckets": dict((str(bucket), count)
+                                for (bucket, count) in self.buckets.items())}
+
+
+class Recording(object):
+    """Timestamps of one utterance. Stages are (name, time) in the order
+    reached; actions are [label, start, end]."""
+
+    __slots__ = ("metrics", "environment", "stages", "actions")
+
+    def __init__(self, metrics, environment):
+        self.metrics = metrics
+        self.environment = environment
+        self.stages = [("callback", utils.clock())]
+        self.actions = []
+
+    def stage(self, name):
+        self.stages.append((name, utils.clock()))
+
+    def begin_action(self, label):
+        self.actions.append([label, utils.clock(), None])
+
+    def end_action(self):
+        self.actions[-1][2] = utils.clock()
+
+    def finish(self):
+        self.stage("done")
+        self.metrics.record(self)
+
+    def abandon(self):
+        self.metrics.discard(self)
+
+
+class LatencyMetrics(object):
+    """Aggregates finished Recordings. For each environment, stage histograms
+    hold the time since the previous stage and "total" the time from callback
+    to the last stage. For each command, the histogram holds the time from
+    callback until its action finished."""
+
+    def __init__(self):
+        self.stages = {}
+        self.commands = {}
+        self.incomplete = 0
+
+    def start(self, environment):
+        return Recording(self, environment)
+
+    def record(self, recording):
+        (_, start) = recording.stages[0]
+        stages = self.stages.setdefault(recording.environment, {})
+        previous = start
+        for (name, time) in recording.stages[1:]:
+            stages.setdefault(name, Histogram()).add(time - previous)
+            previous = time
+        stages.setdefault("total", Histogram()).add(previous - start)
+        for (label, _, end) in recording.actions:
+            if label and end is not None:
+                self.commands.setdefault(label, Histogram()).add(end - start)
+
+    def discard(self, recording):
+        self.incomplete += 1
+
+    def print_report(self, top=20):
+        row = "  %-24s %6d %8.1f %8.1f %8.1f %8.1f"
+        header = "  %-24s %6s %8s %8s %8s %8s" % ("", "count", "p50", "p95",
+                                                  "p99", "max")
+        for (environment, stages) in sorted(self.stages.items()):
+            print("%s (ms)" % environment)
+            print(header)
+            for (name, histogram) in sorted(stages.items(),
+                                            key=lambda item: STAGES.index(item[0])):
+                print(row % ((name,) + self._row(histogram)))
+        print("Slowest commands, callback to done (ms)")
+        print(header)
+        commands = sorted(self.commands.items(),
+                          key=lambda item: -item[1].percentile(95))
+        for (label, histogram) in commands[:top]:
+            print(row % ((label[:24],) + self._row(histogram)))
+        if self.incomplete:
+            print("%d utterances dropped, cancelled or failed" % self.incomplete)
+
+    def write(self, path=DEFAULT_PATH):
+        metrics = {
+            "environments": dict(
+                (environment, dict((name, histogram.summary())
+                                   for (name, histogram) in stages.items()))
+                for (environment, stages) in self.stages.items()),
+            "commands": dict((label, histogram.summary())
+                             for (label, histogram) in self.commands.items()),
+            "incomplete": self.incomplete,
+        }
+        make_parent(path)
+        with open(path, "w") as f:
+            json.dump(metrics, f, indent=2, sort_keys=True)
+        print("Wrote latency metrics to %s" % path)
+
+    def dump(self):
+        self.print_report()
+        self.write()
+
+    def _row(self, histogram):
+        return (histogram.count, histogram.percentile(50) * 1000,
+                histogram.percentile(95) * 1000, histogram.percentile(99) * 1000,
+                histogram.max * 1000)
+
+
+latency = LatencyMetrics()
+
+
+class SessionProfiler(object):
+    """Profiles calls made through run() between start() and stop(). Each
+    thread gets its own profile; stop() merges them and writes path.txt, a
+    report sorted by cumulative time, and path.prof for other tools."""
+
+    def __init__(self, path=PROFILE_PATH):
+        self.path = path
+        self.session = 0
+        self.enabled = False
+        self.profiles = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def start(self):
+        with self.lock:
+            self.session += 1
+            self.profiles = []
+            self.enabled = True
+        print("Profiling started")
+
+    def stop(self, top=30):
+        with self.lock:
+            self.enabled = False
+            profiles = self.profiles
+            self.profiles = []
+        # Calls still in progress on other threads are left out.
+        profiles = [profile for profile in profiles if not profile.active]
+        if not profiles:
+            print("Nothing was profiled")
+            return
+        make_parent(self.path)
+        with open(self.path + ".txt", "w") as f:
+            stats = pstats.Stats(profiles[0].profile, stream=f)
+            for profile in profiles[1:]:
+                stats.add(profile.profile)
+            stats.dump_stats(self.path + ".prof")
+            stats.sort_stats("cumulative").print_stats()
+        print("Profiled %d calls on %d threads; wrote %s.txt" %
+              (sum(profile.calls for profile in profiles), len(profiles),
+               self.path))
+        stats.stream = sys.stdout
+        stats.print_stats(top)
+
+    def run(self, function, *args, **kwargs):
+        if not self.enabled:
+            return function(*args, **kwargs)
+        profile = getattr(self.local, "profile", None)
+        if profile is None or profile.session != self.session:
+            profile = self.local.profile = ThreadProfile(self.session)
+            with self.lock:
+                self.profiles.append(profile)
+        if profile.active:
+            # Already inside a profiled call on this thread.
+            return function(*args, **kwargs)
+        profile.active = True
+        profile.calls += 1
+        try:
+            return profile.profile.runcall(function, *args, **kwargs)
+        finally:
+            profile.active = False
+
+
+class ThreadProfile(object):
+
+    def __init__(self, session):
+        self.session = session
+        self.profile = cProfile.Profile()
+        self.active = False
+        self.calls = 0
+
+
+profiler = SessionProfiler()
+
+
+class UsageCounts(object):
+    """Number of times each command spec was spoken, across sessions."""
+
+    def __init__(self, path=USAGE_PATH):
+        self.path = path
+        self.counts = {}
+        if os.path.isfile(path):
+            try:
+                with open(path) as f:
+                    self.counts = dict((str(spec), count)
+                                       for (spec, count) in json.load(f).items())
+            except ValueError:
+                print("Ignoring corrupt usage counts in %s" % path)
+
+    def count(self, spec):
+        self.counts[spec] = self.counts.get(spec, 0) + 1
+
+    def save(self):
+        make_parent(self.path)
+        with open(self.path, "w") as f:
+            json.dump(self.counts, f, indent=2, sort_keys=True)
+
+    def split(self, action_map, coverage=0.95, min_count=3, min_total=1000):
+        """Splits action_map into (hot, cold) maps. Hot holds the most used
+        commands that together account for coverage of the uses of commands in
+        the map, and any used at least min_count times. Until the map's
+        commands have been used min_total times, everything is hot."""
+        counts = [(self.counts.get(spec, 0), spec) for spec in action_map]
+        total = sum(count for (count, _) in counts)
+        if total < min_total:
+            return (dict(action_map), {})
+        hot = {}
+        cold = {}
+        covered = 0
+        for (count, spec) in sorted(counts, reverse=True):
+            if covered < coverage * total or count >= min_count:
+                hot[spec] = action_map[spec]
+            else:
+                cold[spec] = action_map[spec]
+            covered += count
+        return (hot, cold)
+
+
+usage = UsageCounts()
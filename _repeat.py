@@ -74,6 +74,10 @@ import dragonfly.log
 import _dragonfly_utils as utils
 import _dragonfly_local as local
 import _eye_tracker_utils as eye_tracker
+import _execution_utils as execution
+import _metrics_utils as metrics
+
+utils.paste_threshold = getattr(local, "PASTE_THRESHOLD", utils.paste_threshold)
 
 # import _linux_utils as linux
 # import _text_utils as text
@@ -304,10 +308,17 @@ global_key_action_map = {
 # used anywhere except after commands which include arbitrary dictation.
 # TODO: customize
 def move_click(pos):
-    return Mouse("%s/10" % pos) + Mouse("left")
+    return utils.Timeline("%s/10" % pos, "left")
 
 
-release = Key("shift:up, ctrl:up, alt:up")
+release = utils.ReleaseModifiers()
+# Wait for the copy to land, so that a command following it in the same
+# utterance sees the new clipboard.
+copy_selection = utils.WaitUntil(Key("c-c"), utils.clipboard_change, 250, name="Copy")
+executor = execution.ActionExecutor(
+    cleanup=release,
+    abort_on_overrun=getattr(local, "ABORT_SLOW_PLANS", False),
+    profiler=metrics.profiler)
 key_action_map = {
     # "up [<n>]":                         Key("up/5:%(n)d"),
     # "down [<n>]":                       Key("down/5:%(n)d"),
@@ -315,6 +326,7 @@ key_action_map = {
     # "right [<n>]":                      Key("right/5:%(n)d"),
     "(I|eye) connect": Function(eye_tracker.connect),
     "(I|eye) disconnect": Function(eye_tracker.disconnect),
+    "(I|eye) status": Function(eye_tracker.print_status),
     "(I|eye) print position": Function(eye_tracker.print_position),
     "(I|eye) move": Function(eye_tracker.move_to_position),
     "(I|eye) click": Function(eye_tracker.move_to_position) + Mouse("left"),
@@ -327,10 +339,12 @@ key_action_map = {
     "(I|eye) drag": Function(eye_tracker.move_to_position) + Mouse("left:down"),
     "(I|eye) release": Function(eye_tracker.move_to_position) + Mouse("left:up"),
 
-    # "scrup": Function(lambda: eye_tracker.move_to_position((0, 50))) + Mouse("scrollup:8"),
-    # "half scrup": Function(lambda: eye_tracker.move_to_position((0, 50))) + Mouse("scrollup:4"),
-    # "scrown": Function(lambda: eye_tracker.move_to_position((0, -50))) + Mouse("scrolldown:8"),
-    # "half scrown": Function(lambda: eye_tracker.move_to_position((0, -50))) + Mouse("scrolldown:4"),
+    "(I|eye) scroll": utils.EngineFunction(eye_tracker.start_scrolling),
+    "scrup": utils.EngineFunction(lambda: eye_tracker.start_scrolling(1)),
+    "half scrup": utils.EngineFunction(lambda: eye_tracker.start_scrolling(1, 0.5)),
+    "scrown": utils.EngineFunction(lambda: eye_tracker.start_scrolling(-1)),
+    "half scrown": utils.EngineFunction(lambda: eye_tracker.start_scrolling(-1, 0.5)),
+    "stop scrolling": utils.EngineFunction(eye_tracker.stop_scrolling),
     "do click": Mouse("left"),
     "do right click": Mouse("right"),
     "do middle click": Mouse("middle"),
@@ -338,6 +352,12 @@ key_action_map = {
     "do triple click": Mouse("left:3"),
     "do drag": Mouse("left:down"),
     "do release": Mouse("left:up"),
+    "release modifiers": utils.ReleaseModifiers(force=True),
+    "timeline report": Function(utils.print_timeline_report),
+    "audit latency": Function(lambda: audit_latency()),
+    "benchmark dispatch": Function(utils.benchmark_dispatch),
+    "wait report": Function(utils.print_wait_report),
+    "benchmark text insertion": Function(utils.benchmark_text_insertion),
 }
 
 """
@@ -373,7 +393,7 @@ key_action_map = {
     "play pause|pause play": Key("playpause"),
 
     "paste":                            release + Key("c-v"),
-    "copy":                             release + Key("c-c"),
+    "copy":                             release + copy_selection,
     "cut":                              release + Key("c-x"),
     "select everything":                       release + Key("c-a"),
     "edit text": utils.RunApp("notepad"),
@@ -424,7 +444,7 @@ if namespace:
             def wrap_function(function):
                 def _function(dictation):
                     formatted_text = function(dictation)
-                    Text(formatted_text).execute()
+                    utils.insert_text(formatted_text)
 
                 return Function(_function)
 
@@ -518,7 +538,7 @@ custom_format_rule = utils.create_rule(
 dictation_rule = utils.create_rule(
     "DictationRule",
     {
-        "(mim|mimic) text <text>": release + Text("%(text)s"),
+        "(mim|mimic) text <text>": release + utils.bulk_text_action("%(text)s"),
         "mim small <text>": release + utils.uncapitalize_text_action("%(text)s"),
         "mim big <text>": release + utils.capitalize_text_action("%(text)s"),
         "mimic <text>": release + Mimic(extra="text"),
@@ -669,8 +689,19 @@ class RepeatRule(CompoundRule):
     #  - extras -- dict of the "extras" special elements:
     #     . extras["sequence"] gives the sequence of actions.
     #     . extras["n"] gives the repeat count.
+    #
+    # Starts timing the utterance before its extras are decoded, and profiles
+    # it if profiling is on.
+    def process_recognition(self, node):
+        self.recording = metrics.latency.start(self.grammar.name)
+        metrics.profiler.run(CompoundRule.process_recognition, self, node)
+
+    # The actions are queued on the executor rather than run here, so that
+    # the next utterance can be recognized (and can cancel them) meanwhile.
     def _process_recognition(self, node, extras):
-        print node
+        self.recording.stage("decoded")
+        if benchmarking:
+            return
         sequence = extras["sequence"]  # A sequence of actions.
         nested_repetitions = extras["nested_repetitions"]
         dictation_sequence = extras["dictation_sequence"]
@@ -678,20 +709,22 @@ class RepeatRule(CompoundRule):
         terminal_command = extras["terminal_command"]
         #        final_command = extras["final_command"]
         count = extras["n"]  # An integer repeat count.
+        for action in sequence + [terminal_command]:
+            command = utils.command_of(action)
+            if command:
+                metrics.usage.count(command.spec)
+        plan = []
         for i in range(count):
-            for action in sequence:
-                action.execute()
-                # Pause("5").execute()
+            plan.extend(sequence)
             if nested_repetitions:
-                nested_repetitions.execute()
-            for action in dictation_sequence:
-                action.execute()
-                # Pause("5").execute()
+                plan.append(nested_repetitions)
+            plan.extend(dictation_sequence)
             if dictation:
-                dictation.execute()
+                plan.append(dictation)
             if terminal_command:
-                terminal_command.execute()
-        release.execute()
+                plan.append(terminal_command)
+        plan.append(release)
+        executor.submit(plan, self.recording)
 
 
 # if final_command:
@@ -702,7 +735,9 @@ class RepeatRule(CompoundRule):
 # Define top-level rules for different contexts. Note that Dragon only allows
 # top-level rules to be context-specific, but we want control over sub-rules. To
 # work around this limitation, we compile a mutually exclusive top-level rule
-# for each context.
+# for each context. The dispatcher picks the one to activate for each window.
+
+dispatcher = utils.ContextDispatcher()
 
 class Environment(object):
     """Environment where voice commands can be spoken. Combines grammar and context
@@ -716,6 +751,7 @@ class Environment(object):
                  context=None,
                  parent=None):
         self.name = name
+        self.parent = parent
         self.children = []
         if parent:
             parent.add_child(self)
@@ -733,17 +769,28 @@ class Environment(object):
     def add_child(self, child):
         self.children.append(child)
 
-    def install(self, exported_rule_factory):
+    def rule_maps(self):
+        """Returns (rule name, action map, element map) for each rule of this
+        environment and its descendants."""
+        maps = [(self.name + "_" + key, action_map, element_map)
+                for (key, (action_map, element_map)) in self.environment_map.items()]
+        for child in self.children:
+            maps.extend(child.rule_maps())
+        return maps
+
+    def install(self, exported_rule_factory, transform=None):
+        """Loads a grammar for this environment and each descendant. If given,
+        transform is applied to each environment map before it is compiled.
+        Descendants are added to the dispatcher first, so they take precedence.
+        """
         grammars = []
-        exclusive_context = self.context
         for child in self.children:
-            grammars.extend(child.install(exported_rule_factory))
-            child.install(exported_rule_factory)
-            exclusive_context = utils.combine_contexts(exclusive_context, ~child.context)
+            grammars.extend(child.install(exported_rule_factory, transform))
+        environment_map = transform(self.environment_map) if transform else self.environment_map
         rule_map = dict([(key, RuleRef(
             rule=utils.create_rule(self.name + "_" + key, action_map, element_map)) if action_map else Empty())
-                         for (key, (action_map, element_map)) in self.environment_map.items()])
-        grammar = Grammar(self.name, context=exclusive_context)
+                         for (key, (action_map, element_map)) in environment_map.items()])
+        grammar = Grammar(self.name, context=dispatcher.context(self.name, self.context))
         grammar.add_rule(exported_rule_factory(self.name + "_exported", **rule_map))
         grammar.load()
         grammars.append(grammar)
@@ -772,11 +819,26 @@ class MyEnvironment(object):
     def add_child(self, child):
         self.environment.add_child(child.environment)
 
-    def install(self):
+    def install(self, usage=None):
+        """Loads the grammars. If usage (a _metrics_utils.UsageCounts) is given,
+        rarely spoken commands are only recognized as the terminal command."""
         def create_exported_rule(name, command, terminal_command):
             return RepeatRule(name, command or Empty(), terminal_command or Empty())
 
-        return self.environment.install(create_exported_rule)
+        return self.environment.install(create_exported_rule,
+                                        prune_environment_map(usage) if usage else None)
+
+
+def prune_environment_map(usage):
+    def prune(environment_map):
+        action_map, element_map = environment_map["command"]
+        terminal_action_map, terminal_element_map = environment_map["terminal_command"]
+        hot, cold = usage.split(action_map)
+        return {"command": (hot, element_map),
+                "terminal_command": (utils.combine_maps(cold, terminal_action_map),
+                                     utils.combine_maps(element_map, terminal_element_map))}
+
+    return prune
 
 
 ### Global
@@ -988,19 +1050,27 @@ rust_action_map = {
 
 rust_action_map = dict((k, Text(v)) for (k, v) in rust_action_map.iteritems())
 
-if local.ENABLE_RUST:
-    global_environment = MyEnvironment(name="Rust",
-                                       parent=global_environment,
-                                       action_map=rust_action_map,
-                                       element_map=dict({
-                                           "letter": DictListRef(None, DictList("letters_map", letters_map)),
-                                       }))
+
+# The IntelliJ popups take focus once open. Wait for that rather than a fixed
+# pause, but no longer than the pause used to be.
+intellij_file_popup = utils.WaitUntil(Key("csa-f"), utils.window_change, 250,
+                                      name="IntelliJ file popup")
+intellij_class_popup = utils.WaitUntil(Key("c-n"), utils.window_change, 250,
+                                       name="IntelliJ class popup")
+
+
+def calibrate_intellij_popups():
+    for popup in (intellij_file_popup, intellij_class_popup):
+        utils.calibrate_wait(popup, Key("escape"))
+    utils.print_wait_report()
+
 
 intellij_action_map = {
     "run program": Key("s-f10") + Key("ca-l"),
     "rerun": Key("c-f5") + Key("ca-l"),
-    "open file [<dictation>]": Key("csa-f/25") + Text("%(dictation)s"),
-    "open class [<dictation>]": Key("c-n/25") + Text("%(dictation)s"),
+    "open file [<dictation>]": intellij_file_popup + Text("%(dictation)s"),
+    "open class [<dictation>]": intellij_class_popup + Text("%(dictation)s"),
+    "calibrate popups": Function(calibrate_intellij_popups),
     "close file": Key("c-f4"),
     "previous file": Key("c-tab"),
     "Go to definition": Key("c-b"),
@@ -1076,42 +1146,36 @@ go_action_map = {
     "Go to definition": vexec(":GoDef") + Key("enter"),
 }
 
-if local.ENABLE_GOLANG:
-    global_environment = MyEnvironment(name="Golang",
-                                       parent=global_environment,
-                                       action_map=go_action_map,
-                                       element_map=dict({
-                                       }))
 ### Shell command
 shell_command_map = utils.combine_maps({
-    "git commit": Text("git commit -am "),
-    "git fixup": Text("git fixup"),
-    "git fixup dash a": Text("git fixup -a"),
-    "git commit done": Text("git commit -am done "),
-    "git checkout new": Text("git checkout -b "),
-    "git reset hard head": Text("git reset --hard HEAD "),
-    "git fetch and rebase": Text("git fetch && git rebase"),
-    "arc diff": Text("arc diff"),
-    "arc land": Text("arc land"),
-    "arc queue status": Text("arc queue-status"),
-    "(soft|sym) link": Text("ln -s "),
-    "list": Text("ls -l "),
-    "make dear": Text("mkdir "),
-    "ps (a UX|aux)": Text("ps aux "),
-    "kill command": Text("kill "),
-    "pipe": Text(" | "),
-    "CH mod": Text("chmod "),
-    "TK diff": Text("tkdiff "),
-    "MV": Text("mv "),
-    "CP": Text("cp "),
-    "RM": Text("rm "),
-    "CD": Text("cd "),
-    "LS": Text("ls "),
-    "PS": Text("ps "),
-    "reset terminal": Text("exec bash\n"),
-    "pseudo": Text("sudo "),
-    "apt get": Text("apt-get "),
-}, dict((command, Text(command + " ")) for command in [
+    "git commit": utils.bulk_text_action("git commit -am "),
+    "git fixup": utils.bulk_text_action("git fixup"),
+    "git fixup dash a": utils.bulk_text_action("git fixup -a"),
+    "git commit done": utils.bulk_text_action("git commit -am done "),
+    "git checkout new": utils.bulk_text_action("git checkout -b "),
+    "git reset hard head": utils.bulk_text_action("git reset --hard HEAD "),
+    "git fetch and rebase": utils.bulk_text_action("git fetch && git rebase"),
+    "arc diff": utils.bulk_text_action("arc diff"),
+    "arc land": utils.bulk_text_action("arc land"),
+    "arc queue status": utils.bulk_text_action("arc queue-status"),
+    "(soft|sym) link": utils.bulk_text_action("ln -s "),
+    "list": utils.bulk_text_action("ls -l "),
+    "make dear": utils.bulk_text_action("mkdir "),
+    "ps (a UX|aux)": utils.bulk_text_action("ps aux "),
+    "kill command": utils.bulk_text_action("kill "),
+    "pipe": utils.bulk_text_action(" | "),
+    "CH mod": utils.bulk_text_action("chmod "),
+    "TK diff": utils.bulk_text_action("tkdiff "),
+    "MV": utils.bulk_text_action("mv "),
+    "CP": utils.bulk_text_action("cp "),
+    "RM": utils.bulk_text_action("rm "),
+    "CD": utils.bulk_text_action("cd "),
+    "LS": utils.bulk_text_action("ls "),
+    "PS": utils.bulk_text_action("ps "),
+    "reset terminal": utils.bulk_text_action("exec bash\n"),
+    "pseudo": utils.bulk_text_action("sudo "),
+    "apt get": utils.bulk_text_action("apt-get "),
+}, dict((command, utils.bulk_text_action(command + " ")) for command in [
     "echo",
     "grep",
     "ssh",
@@ -1129,44 +1193,90 @@ shell_command_map = utils.combine_maps({
     "git pull",
 ]))
 
-global_environment = MyEnvironment(name="Shell",
+### Language packs
+# Languages are siblings below the tmux environment rather than stacked on each
+# other, each active only when the window title shows a file of its type, so
+# that their vocabularies don't compete. Titles are only checked in editors and
+# terminals, so that a browser showing "docs.rs" or a "Bash tutorial" leaves
+# them off.
+
+editor_context = utils.executable_context(
+    getattr(local, "EDITOR_EXECUTABLES", ["idea", "vim", "emacs", "code.exe"]))
+terminal_context = utils.executable_context(
+    getattr(local, "TERMINAL_EXECUTABLES", ["mintty", "putty", "conemu",
+                                            "windowsterminal", "cmd.exe",
+                                            "powershell"]))
+
+if local.ENABLE_RUST:
+    rust_environment = MyEnvironment(name="Rust",
+                                     parent=global_environment,
+                                     action_map=rust_action_map,
+                                     context=(utils.FileTypeContext(r"\.rs\b") &
+                                              (editor_context | terminal_context)),
+                                     element_map=dict({
+                                         "letter": DictListRef(None, DictList("letters_map", letters_map)),
+                                     }))
+
+if local.ENABLE_GOLANG:
+    go_environment = MyEnvironment(name="Golang",
                                    parent=global_environment,
-                                   action_map=shell_command_map,
+                                   action_map=go_action_map,
+                                   context=(utils.FileTypeContext(r"\.go\b") &
+                                            (editor_context | terminal_context)),
                                    element_map=dict({
                                    }))
+
+# Terminal titles name the shell or show user@host: from the prompt. Editors
+# inside a terminal show a file name instead, matched by the packs above.
+shell_environment = MyEnvironment(name="Shell",
+                                  parent=global_environment,
+                                  action_map=shell_command_map,
+                                  context=(utils.FileTypeContext(
+                                      getattr(local, "SHELL_TITLE_PATTERN",
+                                              r"\b(bash|zsh|fish|powershell|cmd\.exe)\b|"
+                                              r"^[\w.-]+@[\w.-]+:")) &
+                                           terminal_context),
+                                  element_map=dict({
+                                  }))
 # run_local_hook("AddShellCommands", shell_command_map)
 
 gaming_action_map = {
     # Hearthstone
     "click": Function(eye_tracker.move_to_position) + Mouse("left"),
-    "bump": Function(eye_tracker.move_to_position) + Mouse("left/500") + Function(eye_tracker.move_to_position) + Mouse("left"),
+    "bump": utils.Timeline(Function(eye_tracker.move_to_position), "left/500", Function(eye_tracker.move_to_position), "left"),
     "face": Mouse("[1935, 365]") + Mouse("left"),
-    "done": Mouse("[3125, 961]") + Mouse("left/100") + Mouse("[3125, 1100]"),
+    "done": utils.Timeline("[3125, 961]", "left/100", "[3125, 1100]"),
     "token": Mouse("[2257, 1667]") + Mouse("left"),
     "play": Mouse("[2775, 1768]") + Mouse("left"),
     "confirm": Mouse("[1847, 1745]") + Mouse("left"),
     "cancel": Mouse("[1942, 1829]") + Mouse("left"),
-    "hit face": Function(eye_tracker.move_to_position) + Mouse("left/25") + Mouse("[1935, 365]") + Mouse("left"),
-    "smorc": Function(eye_tracker.move_to_position) + Mouse("left/25") + Mouse("[1935, 365]") + Mouse("left"),
-    "ping face": Mouse("[2257, 1667]") + Mouse("left/25") + Mouse("[1935, 365]") + Mouse("left"),
-    "ping": Mouse("[2257, 1667]") + Mouse("left/25") + Function(eye_tracker.move_to_position) + Mouse("left"),
-    "face tank": Mouse("[1949, 1658]") + Mouse("left/25") + Function(eye_tracker.move_to_position) + Mouse("left"),
-    "hunt": Mouse("[1949, 1658]") + Mouse("left/25") + Mouse("[1935, 365]") + Mouse("left"),
-    "spell": Function(eye_tracker.move_to_position) + Mouse("left/25") + Mouse("[1935, 365]") + Mouse("left"),
-    "put left": Function(eye_tracker.move_to_position) + Mouse("left/25") + Mouse("[955, 1146]") + Mouse("left"),
-    "put right": Function(eye_tracker.move_to_position) + Mouse("left/25") + Mouse("[2825, 1145]") + Mouse("left"),
-    "reveal pack": Mouse("[793, 1031]") + Mouse("left:down/15") + Mouse("[2243, 1050]") + Mouse("left:up/350")
-                   + Mouse("[2206, 553], left/200")
-                   + Mouse("[2782, 828], left/200")
-                   + Mouse("[2558, 1584], left/200")
-                   + Mouse("[1909, 1529], left/200")
-                   + Mouse("[1667, 789], left/200"),
-    "open pack": Mouse("[793, 1031]") + Mouse("left:down/15") + Mouse("[2243, 1050]") + Mouse("left:up/350")
-                 + Mouse("[2206, 553], left/20")
-                 + Mouse("[2782, 828], left/20")
-                 + Mouse("[2558, 1584], left/20")
-                 + Mouse("[1909, 1529], left/20")
-                 + Mouse("[1667, 789], left/20"),
+    "hit face": utils.Timeline(Function(eye_tracker.move_to_position), "left/25", "[1935, 365]", "left"),
+    "smorc": utils.Timeline(Function(eye_tracker.move_to_position), "left/25", "[1935, 365]", "left"),
+    "ping face": utils.Timeline("[2257, 1667]", "left/25", "[1935, 365]", "left"),
+    "ping": utils.Timeline("[2257, 1667]", "left/25", Function(eye_tracker.move_to_position), "left"),
+    "face tank": utils.Timeline("[1949, 1658]", "left/25", Function(eye_tracker.move_to_position), "left"),
+    "hunt": utils.Timeline("[1949, 1658]", "left/25", "[1935, 365]", "left"),
+    "spell": utils.Timeline(Function(eye_tracker.move_to_position), "left/25", "[1935, 365]", "left"),
+    "put left": utils.Timeline(Function(eye_tracker.move_to_position), "left/25", "[955, 1146]", "left"),
+    "put right": utils.Timeline(Function(eye_tracker.move_to_position), "left/25", "[2825, 1145]", "left"),
+    "reveal pack": utils.Timeline("[793, 1031]",
+                                  "left:down/15",
+                                  "[2243, 1050]",
+                                  "left:up/350",
+                                  "[2206, 553], left/200",
+                                  "[2782, 828], left/200",
+                                  "[2558, 1584], left/200",
+                                  "[1909, 1529], left/200",
+                                  "[1667, 789], left/200"),
+    "open pack": utils.Timeline("[793, 1031]",
+                                "left:down/15",
+                                "[2243, 1050]",
+                                "left:up/350",
+                                "[2206, 553], left/20",
+                                "[2782, 828], left/20",
+                                "[2558, 1584], left/20",
+                                "[1909, 1529], left/20",
+                                "[1667, 789], left/20"),
 
     # Into the Breach,
     "Mech one": Key("a"),
@@ -1180,18 +1290,19 @@ gaming_action_map = {
     "primary": Key("1"),
     "secondary": Key("2"),
     "disarm": Key("q"),
-    "details": Function(eye_tracker.move_to_position) + Key("ctrl:down/500, ctrl:up"),
-    "attack order": Key("alt:down/1200, alt:up"),
+    "details": utils.Timeline(Function(eye_tracker.move_to_position), utils.TrackedKey("ctrl:down"), 500,
+                              utils.TrackedKey("ctrl:up")),
+    "attack order": utils.Timeline(utils.TrackedKey("alt:down"), 1200, utils.TrackedKey("alt:up")),
     "repair": Key("r"),
     "end turn": move_click("[446, 315]"),
     "prep": Function(eye_tracker.move_to_position),
     "go": Mouse("left"),
     "fire": Mouse("left"),
-    "region secured": Mouse("[2974, 1850]/10") + Mouse("left"),
-    "start mission": Mouse("[2438, 1298]/10") + Mouse("left"),
-    "confirm placement": Mouse("[228, 349]/10") + Mouse("left"),
-    "install reactor core": Mouse("[1375, 1353]/10") + Mouse("left"),
-    "understood": Mouse("[2180, 1189]/10") + Mouse("left"),
+    "region secured": utils.Timeline("[2974, 1850]/10", "left"),
+    "start mission": utils.Timeline("[2438, 1298]/10", "left"),
+    "confirm placement": utils.Timeline("[228, 349]/10", "left"),
+    "install reactor core": utils.Timeline("[1375, 1353]/10", "left"),
+    "understood": utils.Timeline("[2180, 1189]/10", "left"),
     "power health": move_click("[1781, 740]"),
     "power move": move_click("[2302, 714]"),
     "power skill": move_click("[898, 1242]"),
@@ -1210,6 +1321,9 @@ gaming_action_map = {
     "no cancel": move_click("[2144, 1133]"),
     "sound": Key("m"),
 }
+for (spec, action) in gaming_action_map.items():
+    if isinstance(action, utils.Timeline):
+        action.name = spec
 
 gaming_environment = MyEnvironment(name="Gaming",
                                    parent=global_environment,
@@ -1984,7 +2098,92 @@ gaming_environment = MyEnvironment(name="Gaming",
 # -------------------------------------------------------------------------------
 # Populate and load the grammar.
 
-grammars = global_environment.install()
+# Set while benchmarking, so that recognitions don't run their actions.
+benchmarking = False
+
+
+def install_environments(prune):
+    global environment_grammars
+    for grammar in environment_grammars:
+        grammar.unload()
+    dispatcher.clear()
+    environment_grammars = global_environment.install(metrics.usage if prune else None)
+
+
+def benchmark_pruning(phrases=20, repeat=5):
+    """Mimics the most used literal commands with the grammars built with and
+    without pruning, printing the number of repeatable commands in each
+    environment and the mean recognition time.
+
+    Mimic skips the acoustic search, so this measures only the overhead of
+    matching words against the grammar and decoding the result, not how
+    pruning speeds up recognition of speech. That needs real utterances timed
+    from the end of speech, in sessions with PRUNE_GRAMMAR on and off.
+    """
+    global benchmarking
+    environments = [global_environment.environment]
+    for environment in environments:
+        environments.extend(environment.children)
+    prune = prune_environment_map(metrics.usage)
+    print "Repeatable commands, full -> pruned:"
+    for environment in environments:
+        print "  %s: %d -> %d" % (environment.name,
+                                  len(environment.environment_map["command"][0]),
+                                  len(prune(environment.environment_map)["command"][0]))
+    action_map = global_environment.environment.environment_map["command"][0]
+    specs = sorted(action_map, key=lambda spec: -metrics.usage.counts.get(spec, 0))
+    words = [spec.split() for spec in specs
+             if spec.replace(" ", "").isalpha()][:phrases]
+    engine = get_engine()
+    benchmarking = True
+    try:
+        for pruned in (False, True):
+            install_environments(pruned)
+            failures = 0
+            start = utils.clock()
+            for _ in range(repeat):
+                for phrase in words:
+                    try:
+                        engine.mimic(phrase)
+                    except Exception:
+                        failures += 1
+            elapsed = utils.clock() - start
+            print "%s: %.1fms per mimicked recognition, %d failed" % (
+                "Pruned" if pruned else "Full", elapsed / (repeat * len(words)) * 1000,
+                failures)
+    finally:
+        benchmarking = False
+        install_environments(PRUNE_GRAMMAR)
+
+
+PRUNE_GRAMMAR = getattr(local, "PRUNE_GRAMMAR", False)
+environment_grammars = []
+install_environments(PRUNE_GRAMMAR)
+grammars = []
+
+# Commands handled as soon as they are recognized, rather than queued behind
+# running actions.
+executor_grammar = Grammar("Executor")
+executor_grammar.add_rule(utils.create_rule("ExecutorRule", {
+    "stop that|cancel that": Function(executor.cancel),
+    "executor status": Function(executor.print_metrics),
+    "latency report": Function(metrics.latency.dump),
+    "start profiling": Function(metrics.profiler.start),
+    "stop profiling": Function(metrics.profiler.stop),
+    # Run outside this recognition callback, so the mimics can be recognized.
+    "benchmark pruning": Function(
+        lambda: get_engine().create_timer(benchmark_pruning, 0.1, repeating=False)),
+}, {}, exported=True))
+executor_grammar.load()
+grammars.append(executor_grammar)
+executor.start()
+
+
+def audit_latency():
+    environment = global_environment.environment
+    while environment.parent:
+        environment = environment.parent
+    utils.print_latency_audit(environment.rule_maps())
 
 # TODO Figure out either how to integrate this with the repeating rule or move out.
 # grammar.add_rule(linux_rule)
@@ -2059,7 +2258,7 @@ grammars = global_environment.install()
 ## Connect to Chrome WebDriver if possible.
 # webdriver.create_driver()
 #
-## Connect to eye tracker if possible.
+## Connect to eye tracker in the background, retrying if it isn't available.
 eye_tracker.connect()
 
 print("Loaded _repeat.py")
@@ -2069,9 +2268,13 @@ print("Loaded _repeat.py")
 # Unload function which will be called by NatLink.
 def unload():
     global grammars, timer  # , server, server_thread, timer
-    for grammar in grammars:
+    for grammar in environment_grammars + grammars:
         grammar.unload()
-    # eye_tracker.disconnect()
+    executor.stop()
+    metrics.latency.write()
+    metrics.usage.save()
+    eye_tracker.stop_scrolling()
+    eye_tracker.disconnect()
     #    webdriver.quit_driver()
     timer.stop()
     #    server.shutdown()
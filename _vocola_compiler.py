@@ -0,0 +1,155 @@
+# _vocola_compiler.py - long-lived Vocola compiler service
+#
+# Contains:
+#    - A small pool of worker processes that keep vcl2py loaded
+#    - The per-job entry point run inside those workers
+#
+# This module is imported both by _vocola_main (inside NatLink) and by
+# the worker processes, so it must not import natlink or anything that
+# depends on it.
+#
+
+import io
+import os
+import sys
+import traceback
+
+
+LOG_NAME = 'vcl2py_log.txt'
+
+
+
+###########################################################################
+#                                                                         #
+# The service (runs inside NatLink)                                       #
+#                                                                         #
+###########################################################################
+
+class CompilerService(object):
+
+    def __init__(self, compiler, executable, processes=2):
+        import multiprocessing
+        # NatLink embeds Python inside natspeak.exe, so point
+        # multiprocessing at a real interpreter; pythonw avoids a
+        # console window popping up for each worker:
+        multiprocessing.set_executable(executable)
+        # multiprocessing copies sys.argv into its children, which an
+        # embedded interpreter may not have:
+        if not hasattr(sys, 'argv'):
+            sys.argv = ['']
+        self.compiler = compiler
+        self.pool     = multiprocessing.Pool(processes)
+
+    # Compile each argument list in jobs, in parallel; returns a list of
+    # (arguments, errors) pairs in the same order, errors being "" when
+    # vcl2py reported nothing.
+    def compile(self, jobs, log_name):
+        work = [(self.compiler, arguments, log_name) for arguments in jobs]
+        return zip(jobs, self.pool.map(compile_job, work))
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+
+###########################################################################
+#                                                                         #
+# The workers                                                             #
+#                                                                         #
+###########################################################################
+
+#
+# Each worker keeps the compiled vcl2py code object plus the contents of
+# every file it has read (extensions.csv, include files, ...), keyed by
+# modification time and size, so repeated compiles only touch the disk
+# for files that actually changed.  vcl2py is run in a fresh namespace
+# each time as it keeps its state in module globals.
+#
+# Only the raw contents are cached: vcl2py still parses extensions.csv
+# and every include on each job, as it has no way to take them
+# pre-parsed.
+#
+
+compiler_code = {}   # path -> (mtime, code object)
+file_cache    = {}   # (path, mode) -> (mtime, size, contents)
+
+def compile_job(job):
+    compiler, arguments, log_name = job
+    log = []
+    namespace = {'__name__': '__main__',
+                 '__file__': compiler,
+                 'open':     make_open(log_name, log)}
+
+    saved  = sys.argv, sys.stdout, sys.stderr
+    output = io.BytesIO()
+    sys.argv   = [compiler] + arguments
+    sys.stdout = sys.stderr = output
+    try:
+        try:
+            exec load_compiler(compiler) in namespace
+        except SystemExit:
+            pass
+        except Exception:
+            log.append(traceback.format_exc())
+    finally:
+        sys.argv, sys.stdout, sys.stderr = saved
+
+    # in case vcl2py wrote its log without going through open():
+    if os.path.isfile(log_name):
+        try:
+            f = open(log_name, 'r')
+            log.append(f.read())
+            f.close()
+            os.remove(log_name)
+        except (IOError, OSError):
+            pass
+    return "".join(log)
+
+def load_compiler(path):
+    mtime = os.stat(path).st_mtime
+    cached = compiler_code.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    f = open(path, 'rU')
+    code = compile(f.read(), path, 'exec')
+    f.close()
+    compiler_code[path] = (mtime, code)
+    return code
+
+# Returns a replacement for open() that serves reads from file_cache and
+# captures writes to the compiler log into log instead of the disk.
+def make_open(log_name, log):
+    log_name = os.path.normcase(os.path.abspath(log_name))
+
+    def cached_open(name, mode='r', *args):
+        if os.path.normcase(os.path.abspath(name)) == log_name \
+                and mode[:1] in 'wa':
+            return LogCapture(log)
+        if mode not in ('r', 'rb', 'rU', 'U'):
+            return open(name, mode, *args)
+        try:
+            info = os.stat(name)
+        except OSError:
+            return open(name, mode, *args)   # let open raise the error
+        key = (os.path.abspath(name), mode)
+        cached = file_cache.get(key)
+        if not cached or cached[:2] != (info.st_mtime, info.st_size):
+            f = open(name, mode, *args)
+            cached = (info.st_mtime, info.st_size, f.read())
+            f.close()
+            file_cache[key] = cached
+        return io.BytesIO(cached[2])
+
+    return cached_open
+
+class LogCapture(io.BytesIO):
+
+    def __init__(self, log):
+        io.BytesIO.__init__(self)
+        self.log = log
+
+    def close(self):
+        if not self.closed:
+            self.log.append(self.getvalue())
+        io.BytesIO.close(self)
@@ -37,6 +37,13 @@ import os.path          # to parse filenames
 import time             # print time in messages
 from   stat import *    # file statistics
 import re
+import hashlib
+import json
+import shutil
+import tempfile
+import threading
+import traceback
+import Queue
 import natlink
 from   natlinkutils import *
 
@@ -59,6 +66,12 @@ except ImportError:
     VocolaEnabled      = True
     language           = 'enx'
 
+VocolaVersion = '2.8.6'
+
+if os.environ.has_key('COMPUTERNAME'):
+    machine = string.lower(os.environ['COMPUTERNAME'])
+else: machine = 'local'
+
 
 # get location of MacroSystem folder:
 NatLinkFolder = os.path.split(
@@ -122,6 +135,205 @@ if VocolaEnabled and not commandFolder:
 import VocolaUtils
 VocolaUtils.Language = language
 
+import _vocola_compiler as vocola_compiler
+# number of worker processes kept around for compiling command files:
+compiler_processes = 2
+
+
+
+###########################################################################
+#                                                                         #
+# Command file catalog                                                    #
+#                                                                         #
+###########################################################################
+
+#
+# Index of the command folder, rebuilt only when the folder's
+# modification time changes (which adding, removing or renaming a file
+# does).  A command file "app_x@machine.vcl" is indexed under each
+# application name it applies to ("app" and "app_x"; "" for global files
+# starting with "_") together with its machine, if any, so finding the
+# files for an application is a dictionary lookup.
+#
+
+class CommandCatalog:
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.mtime  = None
+        self.names  = {}   # lower case file name -> path
+        self.index  = {}   # (application, machine or None) -> paths
+
+    def refresh(self):
+        if not self.folder:
+            return
+        try:
+            mtime = os.path.getmtime(self.folder)
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+
+        self.names = {}
+        self.index = {}
+        files = []
+        if mtime is not None:
+            files = sorted(os.listdir(self.folder))
+        for f in files:
+            path = os.path.join(self.folder, f)
+            name = string.lower(f)
+            self.names[name] = path
+            if not name.endswith('.vcl'):
+                continue
+            stem, at, host = name[:-4].partition('@')
+            host = at and host or None
+            applications = [stem[:i] for i in range(len(stem))
+                            if stem[i] == '_']
+            for application in applications + [stem]:
+                self.index.setdefault((application, host), []).append(path)
+
+    # Returns the paths of all command files
+    def command_files(self):
+        self.refresh()
+        return [path for name, path in sorted(self.names.items())
+                if name.endswith('.vcl')]
+
+    # Returns the paths of the command files for application (a lower
+    # case module name or "" for global files) on machine
+    def lookup(self, application, machine):
+        self.refresh()
+        return self.index.get((application, None), []) + \
+               self.index.get((application, machine), [])
+
+    # Returns the path of file in the command folder or "" if none
+    def find(self, file):
+        self.refresh()
+        return self.names.get(string.lower(file), "")
+
+catalog = CommandCatalog(commandFolder)
+
+
+
+###########################################################################
+#                                                                         #
+# Scanning extensions                                                     #
+#                                                                         #
+###########################################################################
+
+#
+# Keeps the extensions.csv rows produced by each vocola_ext_*.py file,
+# together with the file's modification time, size and hash, in
+# extensions_cache.json.  Only extensions whose contents changed are
+# re-parsed (by running scan_extensions on a folder holding just that
+# file) and extensions.csv is only rewritten when its contents change.
+#
+
+class ExtensionScanner:
+
+    def __init__(self, folder):
+        self.folder    = folder
+        self.csv       = os.path.join(folder, 'extensions.csv')
+        self.cacheName = os.path.join(folder, 'extensions_cache.json')
+        self.cache     = None   # file name -> entry
+
+    # Bring extensions.csv up to date; returns the module names of the
+    # extensions that were added, changed or removed
+    def scan(self, verbose=False):
+        if not os.path.isdir(self.folder):
+            return []
+        if self.cache is None:
+            self.cache = self.load_cache()
+
+        files   = [f for f in os.listdir(self.folder)
+                   if f.startswith('vocola_ext_') and f.endswith('.py')]
+        changed = [f for f in self.cache.keys() if f not in files]
+        for f in changed:
+            del self.cache[f]
+        for f in files:
+            if self.refresh(f, verbose):
+                changed.append(f)
+
+        rows  = []
+        for f in sorted(files):
+            rows += self.cache[f]['rows']
+        contents = "".join(rows)
+        if contents != self.read(self.csv):
+            self.write(self.csv, contents)
+        if changed:
+            self.write(self.cacheName, json.dumps(self.cache, indent=1))
+        return [os.path.splitext(f)[0] for f in changed]
+
+    # A hash of the contents of every extension file as of the last scan
+    def fingerprint(self):
+        digest = hashlib.md5()
+        for f in sorted((self.cache or {}).keys()):
+            digest.update(f + ':' + self.cache[f]['hash'] + '\n')
+        return digest.hexdigest()
+
+    # Re-parse extension file if its contents changed; returns true if so
+    def refresh(self, file, verbose):
+        path  = os.path.join(self.folder, file)
+        info  = os.stat(path)
+        stat  = [info[ST_MTIME], info[ST_SIZE]]
+        entry = self.cache.get(file)
+        if entry and entry['stat'] == stat:
+            return False
+
+        digest = hashlib.md5(self.read(path)).hexdigest()
+        if entry and entry['hash'] == digest:
+            entry['stat'] = stat
+            return False
+
+        self.cache[file] = {'stat': stat,
+                            'hash': digest,
+                            'rows': self.parse(path, verbose)}
+        return True
+
+    # Run scan_extensions over just path; returns the rows it produced
+    def parse(self, path, verbose):
+        import scan_extensions
+        scratch = tempfile.mkdtemp(prefix='vocola_ext_')
+        try:
+            shutil.copy2(path, scratch)
+            arguments = ["scan_extensions", scratch]
+            if verbose:
+                arguments.insert(1, "-v")
+            scan_extensions.main(arguments)
+            f = open(os.path.join(scratch, 'extensions.csv'), 'r')
+            rows = f.readlines()
+            f.close()
+            return rows
+        except IOError:
+            return []
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    def load_cache(self):
+        try:
+            cache = json.loads(self.read(self.cacheName))
+        except ValueError:
+            return {}
+        return dict([(str(f), entry) for f, entry in cache.items()])
+
+    def read(self, file):
+        try:
+            f = open(file, 'rb')
+            contents = f.read()
+            f.close()
+            return contents
+        except IOError:
+            return ""
+
+    def write(self, file, contents):
+        temporary = file + '.tmp'
+        f = open(temporary, 'wb')
+        f.write(contents)
+        f.close()
+        replace_file(temporary, file)
+
+extension_scanner = ExtensionScanner(ExtensionsFolder)
+
 
 
 ###########################################################################
@@ -222,11 +434,12 @@ Commands" are activated.
 
 
     def initialize(self):
-        if os.environ.has_key('COMPUTERNAME'):
-            self.machine = string.lower(os.environ['COMPUTERNAME'])
-        else: self.machine = 'local'
+        self.machine = machine
 
         self.load_extensions()
+        # only now that extensions.csv is current can outputs compiled
+        # against it be validated:
+        validateOutput()
         self.loadAllFiles(False)
 
         self.load(self.gramSpec)
@@ -249,22 +462,17 @@ Commands" are activated.
     # "Show NatLink Window" -- print to output window so it appears
     def gotResults_NatLinkWindow(self, words, fullResults):
         print "This is the NatLink/Vocola output window"
+        print_load_timings()
 
     # "Load Extensions" -- scan for new/changed extensions:
     def gotResults_loadExtensions(self, words, fullResults):
-        self.load_extensions(True)
-        for module in sys.modules.keys():
-            if module.startswith("vocola_ext_"):
+        for module in self.load_extensions(True):
+            if sys.modules.has_key(module):
                 del sys.modules[module]
 
+    # Returns the names of the extension modules that changed
     def load_extensions(self, verbose=False):
-        #if sys.modules.has_key("scan_extensions"):
-        #    del sys.modules["scan_extensions"]
-        import scan_extensions
-        arguments = ["scan_extensions", ExtensionsFolder]
-        if verbose:
-            arguments.insert(1, "-v")
-        scan_extensions.main(arguments)
+        return extension_scanner.scan(verbose)
 
 
 ### Loading Vocola Commands
@@ -293,16 +501,7 @@ Commands" are activated.
 
     # Load command files for specific application
     def loadSpecificFiles(self, module):
-        special = re.compile(r'([][()^$.+*?{\\])')
-        pattern = "^" + special.sub(r'\\\1', module)
-        pattern += "(_[^@]*)?(@" + special.sub(r'\\\1', self.machine)
-        pattern += ")?\.vcl$"
-        p = re.compile(pattern, re.IGNORECASE)
-
-        targets = []
-        if commandFolder:
-            targets += [os.path.join(commandFolder,f)
-                        for f in os.listdir(commandFolder) if p.search(f)]
+        targets = catalog.lookup(string.lower(module), self.machine)
         if len(targets) > 0:
             for target in targets:
                 self.loadFile(target)
@@ -355,11 +554,7 @@ Commands" are activated.
 
 
     def FindExistingCommandFile(self, file):
-        if commandFolder:
-            f = commandFolder + '\\' + file
-            if os.path.isfile(f): return f
-
-        return ""
+        return catalog.find(file)
 
     # Open a Vocola command file (using the application associated with ".vcl")
     def openCommandFile(self, file, comment):
@@ -402,16 +597,98 @@ Commands" are activated.
 ###########################################################################
 
 may_have_compiled = False  # has the compiler been called?
-compile_error     = False  # has a compiler error occurred?
+compiler_error    = False  # has a compiler error occurred?
 
 # Run Vocola compiler, converting command files from "inputFileOrFolder"
-# and writing output to NatLink/MacroSystem
-def compile_Vocola(inputFileOrFolder, force):
+# and writing output to NatLink/MacroSystem.  Unless background is set,
+# waits for the compiler and reports any errors; returns the request.
+def compile_Vocola(inputFileOrFolder, force, background=False):
+    # compile each affected command file as its own job so the compiler
+    # service can spread them across its worker processes:
+    if os.path.isdir(inputFileOrFolder):
+        inputs, removed = build_graph.refresh(
+            command_files(inputFileOrFolder))
+        deleteOrphanFiles(removed)
+        if force:
+            inputs = command_files(inputFileOrFolder)
+    else:
+        inputs = [inputFileOrFolder]
+        build_graph.rehash(inputFileOrFolder)
+
+    request = CompileRequest(inputs, force, background)
+    if inputs:
+        compile_worker().submit(request)
+        if not background:
+            request.done.wait()
+            report_compile(request)
+    else:
+        request.done.set()
+    return request
+
+# Print the errors of a finished compile request and record its outputs
+# in the build graph; must be called from NatLink's thread, never the
+# compile worker's.
+def report_compile(request):
     global may_have_compiled, compiler_error
 
     may_have_compiled = True
+    for input, errors, outputs in request.results:
+        if errors:
+            compiler_error = True
+            print >> sys.stderr, errors
+            build_graph.record(input, None)
+        else:
+            deleteOutputs(build_graph.record(input, outputs))
+            for output in outputs:
+                manifest[output] = manifest_entry(input)
+            changed_outputs.update(outputs)
+            removed_outputs.difference_update(outputs)
+    write_manifest()
+
+# Compile inputs into a private staging folder, then move each
+# successfully compiled output into NatLinkFolder.  Runs on the compile
+# worker thread; returns (input, errors, output names) triples.
+def build(inputs, force):
+    staging = tempfile.mkdtemp(prefix='staging_', dir=VocolaFolder)
+    try:
+        folders = [os.path.join(staging, str(i)) for i in range(len(inputs))]
+        jobs    = []
+        for input, folder in zip(inputs, folders):
+            os.mkdir(folder)
+            jobs.append(compiler_arguments(input, force, folder))
+
+        logName = commandFolder + '\\' + vocola_compiler.LOG_NAME
+        results = []
+        for (arguments, errors), folder in zip(run_compiler(jobs, logName),
+                                               folders):
+            input   = arguments[-2]
+            outputs = []
+            if not errors:
+                outputs = os.listdir(folder)
+                for f in outputs:
+                    replace_file(os.path.join(folder, f),
+                                 os.path.join(NatLinkFolder, f))
+            results.append((input, errors, outputs))
+        return results
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+# Move src over dst in a single step so NatLink never sees a missing or
+# partially written output file
+def replace_file(src, dst):
+    try:
+        import ctypes
+        MOVEFILE_REPLACE_EXISTING = 1
+        if ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst),
+                                              MOVEFILE_REPLACE_EXISTING):
+            return
+    except (ImportError, AttributeError):
+        pass
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
 
-    executable = sys.prefix + r'\python.exe'
+def compiler_arguments(input, force, outputFolder):
     arguments  = [VocolaFolder + r'\exec\vcl2py.py']
 
     arguments += ['-extensions', ExtensionsFolder + r'\extensions.csv']
@@ -422,25 +699,139 @@ def compile_Vocola(inputFileOrFolder, force):
     arguments += ["-suffix", "_vcl"]
     if force: arguments += ["-f"]
 
-    arguments += [inputFileOrFolder, NatLinkFolder]
-    hidden_call(executable, arguments)
+    arguments += [input, outputFolder]
+    return arguments
 
-    logName = commandFolder + r'\vcl2py_log.txt'
+compiler_service = None
+
+# Run the given vcl2py argument lists through the persistent compiler
+# service, falling back to one hidden python process per job if the
+# service cannot be started; returns (arguments, errors) pairs.
+def run_compiler(jobs, logName):
+    global compiler_service
+    if compiler_service is None:
+        try:
+            compiler_service = vocola_compiler.CompilerService(
+                VocolaFolder + r'\exec\vcl2py.py',
+                sys.prefix + r'\pythonw.exe',
+                compiler_processes)
+        except Exception, e:
+            print >> sys.stderr, "Vocola compiler service unavailable " + \
+                "(" + str(e) + "); compiling out of process instead."
+            compiler_service = False
+    if compiler_service:
+        return compiler_service.compile(jobs, logName)
+    return [(arguments, hidden_compile(arguments, logName))
+            for arguments in jobs]
+
+def stop_compiler_service():
+    global compiler_service
+    if compiler_service:
+        compiler_service.close()
+    compiler_service = None
+
+# Run vcl2py in a separate hidden python process, returning the contents
+# of its log file
+def hidden_compile(arguments, logName):
+    hidden_call(sys.prefix + r'\python.exe', arguments)
+
+    errors = ""
     if os.path.isfile(logName):
         try:
             log = open(logName, 'r')
-            compiler_error = True
-            print >> sys.stderr, log.read()
+            errors = log.read()
             log.close()
             os.remove(logName)
         except IOError:  # no log file means no Vocola errors
             pass
+    return errors
+
+
+#
+# All compiling happens on a single worker thread so that a command file
+# change noticed at the start of an utterance never makes the speaker
+# wait on the compiler.  Outputs are compiled into a staging folder and
+# only moved into NatLinkFolder once complete, so the previous outputs
+# stay active until then; the next begin callback picks up the results.
+#
+
+class CompileRequest:
+
+    def __init__(self, inputs, force, background):
+        self.inputs     = inputs
+        self.force      = force
+        self.background = background
+        self.results    = []
+        self.done       = threading.Event()
+
+class CompileWorker(threading.Thread):
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="Vocola compiler")
+        self.setDaemon(True)
+        self.requests = Queue.Queue()
+        self.finished = Queue.Queue()   # background requests to report
+
+    def submit(self, request):
+        self.requests.put(request)
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            try:
+                request.results = build(request.inputs, request.force)
+            except Exception:
+                request.results = [(input, traceback.format_exc(), [])
+                                   for input in request.inputs]
+            if request.background:
+                self.finished.put(request)
+            request.done.set()
+
+    def stop(self):
+        self.requests.put(None)
+        self.join(5)
+
+worker = None
+
+def compile_worker():
+    global worker
+    if worker is None:
+        worker = CompileWorker()
+        worker.start()
+    return worker
+
+def stop_compile_worker():
+    global worker
+    if worker:
+        worker.stop()
+    worker = None
+    stop_compiler_service()
+
+# Report background compiles that have finished since the last call;
+# returns the finished requests.
+def collect_compiles():
+    finished = []
+    if worker:
+        while True:
+            try:
+                request = worker.finished.get_nowait()
+            except Queue.Empty:
+                break
+            report_compile(request)
+            finished.append(request)
+    return finished
 
 # Unload all commands, including those of files no longer existing
 def purgeOutput():
     pattern = re.compile("_vcl\d*\.pyc?$")
     [os.remove(os.path.join(NatLinkFolder,f)) for f
      in os.listdir(NatLinkFolder) if pattern.search(f)]
+    build_graph.clear()
+    manifest.clear()
+    if os.path.isfile(ManifestName):
+        os.remove(ManifestName)
 
 #
 # Run program with path executable and arguments arguments.  Waits for
@@ -463,37 +854,30 @@ def hidden_call(executable, arguments):
         return exit_code
 
 
-lastVocolaFileTime    = 0
-lastCommandFolderTime = 0
+pending_compile = None
 
 def compile_changed():
-    global lastVocolaFileTime, lastCommandFolderTime
-    global compiler_error
-
-    current = getLastVocolaFileModTime()
-    if current > lastVocolaFileTime:
-        compiler_error = False
-        thisGrammar.loadAllFiles(False)
-        if not compiler_error:
-            lastVocolaFileTime = current
-
-    #source_changed = False
-    #if commandFolder:
-    #    if vocolaGetModTime(commandFolder) > lastCommandFolderTime:
-    #        lastCommandFolderTime = vocolaGetModTime(commandFolder)
-    #        source_changed = True
-    #if source_changed:
-    #    deleteOrphanFiles()
-
-# Returns the newest modified time of any Vocola command folder file or
-# 0 if none:
-def getLastVocolaFileModTime():
-    last = 0
+    global pending_compile
+
+    # (check for completion first: a finished request is queued for
+    # reporting before it is marked done)
+    finished = not pending_compile or pending_compile.done.isSet()
+    collect_compiles()
+    if not finished:
+        return
+    pending_compile = None
+
     if commandFolder:
-        last = max([last] +
-                   [vocolaGetModTime(os.path.join(commandFolder,f))
-                    for f in os.listdir(commandFolder)])
-    return last
+        request = compile_Vocola(commandFolder, False, background=True)
+        if request.inputs:
+            pending_compile = request
+
+# Returns the paths of the command files in folder
+def command_files(folder):
+    if folder == catalog.folder:
+        return catalog.command_files()
+    return [os.path.join(folder, f) for f in os.listdir(folder)
+            if f.lower().endswith('.vcl')]
 
 # Returns the modification time of a file or 0 if the file does not exist:
 def vocolaGetModTime(file):
@@ -501,36 +885,289 @@ def vocolaGetModTime(file):
     except OSError: return 0        # file not found
 
 
-def deleteOrphanFiles():
-    print "checking for orphans..."
-    for f in os.listdir(NatLinkFolder):
-        if not re.search("_vcl.pyc?$", f): continue
+# Remove the outputs of command files that no longer exist
+def deleteOrphanFiles(sources):
+    for source in sources:
+        deleteOutputs(build_graph.forget(source))
+    if sources:
+        write_manifest()
+
+def deleteOutputs(outputs):
+    for output in outputs:
+        manifest.pop(output, None)
+        changed_outputs.discard(output)
+        removed_outputs.add(output)
+        for f in [output, output + 'c']:
+            f = os.path.join(NatLinkFolder, f)
+            if os.path.isfile(f):
+                print "Deleting: " + f
+                os.remove(f)
 
-        s = getSourceFilename(f)
-        if s:
-            if vocolaGetModTime(s)>0: continue
 
-        f = os.path.join(NatLinkFolder, f)
-        print "Deleting: " + f
-        os.remove(f)
 
-def getSourceFilename(output_filename):
-    m = re.match("^(.*)_vcl.pyc?$", output_filename)
-    if not m: return None                    # Not a Vocola file
-    name = m.group(1)
-    if not commandFolder: return None
+###########################################################################
+#                                                                         #
+# Build graph                                                             #
+#                                                                         #
+###########################################################################
 
-    marker = "e_s_c_a_p_e_d__"
-    m = re.match("^(.*)" + marker + "(.*)$", name)  # rightmost marker!
-    if m:
-        name = m.group(1)
-        tail = m.group(2)
-        tail = re.sub("__a_t__", "@", tail)
-        tail = re.sub("___", "_", tail)
-        name += tail
+#
+# Records, for every command file, its content hash, the files it
+# includes and the output files compiling it produced.  A change then
+# recompiles only the command files it affects, and orphaned outputs are
+# found through the output -> source index.
+#
 
-    name = re.sub("_@", "@", name)
-    return commandFolder + "\\" + name + ".vcl"
+include_pattern = re.compile(
+    r"""^[ \t]*include[ \t]+(?:"([^"]*)"|'([^']*)'|([^\s;]+))""",
+    re.MULTILINE)
+
+class BuildGraph:
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.stats       = {}     # file -> (mtime, size) when last hashed
+        self.hashes      = {}     # file -> content hash or None if missing
+        self.includes    = {}     # file -> files it includes
+        self.included_by = {}     # file -> files that include it
+        self.compiled    = set()  # command files compiled since last change
+        self.failed      = {}     # command file -> key() when it failed
+        self.outputs     = {}     # command file -> output file names
+        self.sources     = {}     # output file name -> command file
+
+    # Re-hash the given command files plus every file they include;
+    # returns (command files needing a compile, command files removed).
+    def refresh(self, sources):
+        sources = set(sources)
+        changed = [f for f in sources | set(self.stats) if self.rehash(f)]
+        stale   = set([f for f in self.dependents(changed) if f in sources])
+        stale  |= set([f for f in sources - self.compiled
+                       if self.failed.get(f) != self.key(f)])
+        removed = (self.compiled | set(self.outputs)) - sources
+        return sorted(stale), sorted(removed)
+
+    # Re-read file if its size or modification time changed; returns true
+    # if its contents changed (appearing or disappearing counts).
+    def rehash(self, file):
+        try:
+            info = os.stat(file)
+            stat = (info[ST_MTIME], info[ST_SIZE])
+        except OSError:
+            stat = None
+        if file in self.stats and self.stats[file] == stat:
+            return False
+        self.stats[file] = stat
+
+        digest   = None
+        includes = []
+        if stat:
+            try:
+                f = open(file, 'rb')
+                contents = f.read()
+                f.close()
+                digest   = hashlib.md5(contents).hexdigest()
+                includes = [self.resolve(file, "".join(m))
+                            for m in include_pattern.findall(contents)]
+            except IOError:
+                pass
+        self.set_includes(file, includes)
+
+        changed = self.hashes.get(file) != digest
+        self.hashes[file] = digest
+        return changed
+
+    def resolve(self, file, include):
+        path = os.path.join(os.path.dirname(file), include)
+        if not os.path.isfile(path) and commandFolder:
+            path = os.path.join(commandFolder, include)
+        return os.path.normpath(path)
+
+    def set_includes(self, file, includes):
+        for include in self.includes.get(file, []):
+            self.included_by[include].discard(file)
+        self.includes[file] = includes
+        for include in includes:
+            self.included_by.setdefault(include, set()).add(file)
+            if include not in self.stats:
+                self.rehash(include)
+
+    # Returns a hash of source plus everything it (transitively) includes
+    def key(self, source):
+        files = set()
+        todo  = [source]
+        while todo:
+            file = todo.pop()
+            if file not in files:
+                files.add(file)
+                todo.extend(self.includes.get(file, []))
+        digest = hashlib.md5()
+        for file in sorted(files):
+            digest.update("%s=%s\n" % (file, self.hashes.get(file)))
+        return digest.hexdigest()
+
+    # Returns files plus everything that (transitively) includes them
+    def dependents(self, files):
+        result = set()
+        todo   = list(files)
+        while todo:
+            file = todo.pop()
+            if file not in result:
+                result.add(file)
+                todo.extend(self.included_by.get(file, []))
+        return result
+
+    # Record the outputs a compile of source produced (None if it
+    # failed, keeping the old ones); returns no longer produced outputs.
+    # A failed source is retried once it or anything it includes changes,
+    # including an include appearing.
+    def record(self, source, outputs):
+        if outputs is None:
+            self.compiled.discard(source)
+            self.failed[source] = self.key(source)
+            return []
+        self.compiled.add(source)
+        self.failed.pop(source, None)
+        old = self.outputs.get(source, [])
+        for output in old:
+            del self.sources[output]
+        self.outputs[source] = outputs
+        for output in outputs:
+            self.sources[output] = source
+        return [output for output in old if output not in outputs]
+
+    # Stop tracking a removed command file; returns its outputs
+    def forget(self, source):
+        self.compiled.discard(source)
+        self.failed.pop(source, None)
+        self.set_includes(source, [])
+        for table in (self.stats, self.hashes, self.includes):
+            table.pop(source, None)
+        outputs = self.outputs.pop(source, [])
+        for output in outputs:
+            del self.sources[output]
+        return outputs
+
+build_graph = BuildGraph()
+
+
+###########################################################################
+#                                                                         #
+# Output manifest                                                         #
+#                                                                         #
+###########################################################################
+
+#
+# The manifest, stored next to the outputs in NatLinkFolder, records
+# what each output was compiled from (the hash of its command file and
+# includes) and with (compiler version, machine name and language).  At
+# startup outputs whose entry still matches are kept and only the rest
+# is purged, so Dragon only pays for compiling what actually changed.
+#
+
+ManifestName = os.path.join(NatLinkFolder, 'vocola_manifest.json')
+manifest     = {}   # output file name -> entry
+
+def manifest_entry(source):
+    return {'source':   source,
+            'hash':     build_graph.key(source),
+            'compiler': compiler_version(),
+            'machine':  machine,
+            'language': language}
+
+def write_manifest():
+    global lastNatLinkModTime
+    encoding  = sys.getfilesystemencoding()
+    temporary = ManifestName + '.tmp'
+    before    = vocolaGetModTime(NatLinkFolder)
+    try:
+        f = open(temporary, 'w')
+        json.dump(manifest, f, indent=1, sort_keys=True, encoding=encoding)
+        f.close()
+        replace_file(temporary, ManifestName)
+    except (IOError, OSError), e:
+        print >> sys.stderr, "Unable to write Vocola manifest: " + str(e)
+    # writing the manifest changes NatLinkFolder's modification time;
+    # unless outputs or something else changed the folder, don't let that
+    # look to output_changes() like new outputs needing a full rescan:
+    if before <= lastNatLinkModTime and \
+       not (changed_outputs or removed_outputs):
+        lastNatLinkModTime = max(lastNatLinkModTime,
+                                 vocolaGetModTime(NatLinkFolder))
+
+# Keep the outputs whose manifest entry is still valid, seeding the build
+# graph with them, and delete every other Vocola output
+def validateOutput():
+    global manifest
+
+    encoding = sys.getfilesystemencoding()
+    try:
+        f = open(ManifestName, 'r')
+        saved = json.load(f)
+        f.close()
+    except (IOError, ValueError):
+        saved = {}
+
+    build_graph.clear()
+    version = compiler_version()
+    valid   = {}
+    for output, entry in saved.items():
+        output = output.encode(encoding)
+        source = entry.get('source', u'').encode(encoding)
+        if entry.get('compiler') != version or \
+           entry.get('machine')  != machine or \
+           entry.get('language') != language:
+            continue
+        if not os.path.isfile(os.path.join(NatLinkFolder, output)) or \
+           not os.path.isfile(source):
+            continue
+        build_graph.rehash(source)
+        if build_graph.key(source) == entry.get('hash'):
+            entry['source'] = source
+            valid[output]   = entry
+
+    outputs = {}
+    for output, entry in valid.items():
+        outputs.setdefault(entry['source'], []).append(output)
+    for source in outputs:
+        build_graph.record(source, outputs[source])
+
+    pattern = re.compile("_vcl\d*\.pyc?$")
+    for f in os.listdir(NatLinkFolder):
+        if pattern.search(f) and re.sub("c$", "", f) not in valid:
+            os.remove(os.path.join(NatLinkFolder, f))
+    manifest = valid
+    write_manifest()
+
+compiler_versions = {}   # (vcl2py, extensions.csv) stats -> version
+
+# Returns a hash identifying the compiler and the extensions it compiles
+# against (extensions.csv and the extension files themselves); outputs
+# of a different version are considered stale
+def compiler_version():
+    files = [VocolaFolder + r'\exec\vcl2py.py',
+             ExtensionsFolder + r'\extensions.csv']
+    stats = []
+    for file in files:
+        try:
+            info = os.stat(file)
+            stats.append((info[ST_MTIME], info[ST_SIZE]))
+        except OSError:
+            stats.append(None)
+    stats.append(extension_scanner.fingerprint())
+    stats = tuple(stats)
+    if stats not in compiler_versions:
+        digest = hashlib.md5(VocolaVersion + stats[-1])
+        for file in files:
+            try:
+                f = open(file, 'rb')
+                digest.update(f.read())
+                f.close()
+            except IOError:
+                pass
+        compiler_versions[stats] = digest.hexdigest()
+    return compiler_versions[stats]
 
 
 lastNatLinkModTime = 0
@@ -611,15 +1248,72 @@ def vocolaBeginCallback(moduleInfo):
         changes = utterance_start_callback(moduleInfo)
 
     if Quintijn_installer:
+        changed_outputs.clear()
+        removed_outputs.clear()
         return changes
     else:
         if changes > 1:
             # make sure NatLink sees any new .py files:
-            natlinkmain.findAndLoadFiles()
+            load_changed_outputs()
             natlinkmain.loadModSpecific(moduleInfo)
         natlinkmain.beginCallback(moduleInfo)
 
 
+#
+# Rather than have natlinkmain rescan the whole MacroSystem folder when
+# our outputs change, (re)load just the _vcl modules the compiler wrote
+# and unload those whose outputs were deleted.  Application specific
+# modules that are not loaded yet are left to loadModSpecific.  Falls
+# back to a full rescan when the folder changed for some other reason
+# or natlinkmain lacks the hooks we need.
+#
+
+changed_outputs = set()   # output files written since the last load
+removed_outputs = set()   # output files deleted since the last load
+load_timings    = {}      # "targeted"/"full" -> [loads, total seconds]
+
+def load_changed_outputs():
+    start = time.clock()
+    if (changed_outputs or removed_outputs) and \
+       hasattr(natlinkmain, 'loadedFiles') and \
+       hasattr(natlinkmain, 'loadFile'):
+        loaded = natlinkmain.loadedFiles
+        for output in removed_outputs:
+            name = os.path.splitext(output)[0]
+            if name in loaded:
+                unload_module(name)
+                del loaded[name]
+        for output in changed_outputs:
+            name = os.path.splitext(output)[0]
+            if name.startswith('_') or name in loaded:
+                loaded[name] = natlinkmain.loadFile(name, [NatLinkFolder],
+                                                    loaded.get(name))
+        kind = "targeted"
+    else:
+        natlinkmain.findAndLoadFiles()
+        kind = "full"
+    changed_outputs.clear()
+    removed_outputs.clear()
+
+    timing = load_timings.setdefault(kind, [0, 0.0])
+    timing[0] += 1
+    timing[1] += time.clock() - start
+
+def unload_module(name):
+    module = sys.modules.pop(name, None)
+    if module and hasattr(module, 'unload'):
+        try:
+            module.unload()
+        except:
+            traceback.print_exc()
+
+def print_load_timings():
+    for kind in sorted(load_timings.keys()):
+        loads, total = load_timings[kind]
+        print "%s loads of Vocola output: %d, average %.1f ms" % \
+            (kind, loads, 1000 * total / loads)
+
+
 
 ###########################################################################
 #                                                                         #
@@ -629,15 +1323,18 @@ def vocolaBeginCallback(moduleInfo):
 
 thisGrammar = None
 
-# remove previous Vocola/Python compilation output as it may be out of
-# date (e.g., new compiler, source file deleted, partially written due
-# to crash, new machine name, etc.):
-purgeOutput()
+# remove previous Vocola/Python compilation output unless the manifest
+# shows it is still up to date (it may have been made by an older
+# compiler, from a since deleted source file, partially written due to
+# a crash, for another machine name, etc.); when Vocola is enabled,
+# initialize() validates the outputs once extensions have been scanned:
+if not VocolaEnabled:
+    purgeOutput()
 
 if not VocolaEnabled:
     print "Vocola not active"
 else:
-    print "Vocola version 2.8.6 starting..."
+    print "Vocola version " + VocolaVersion + " starting..."
     thisGrammar = ThisGrammar()
     thisGrammar.initialize()
 
@@ -645,5 +1342,6 @@ else:
 def unload():
     global thisGrammar
     disable_callback()
+    stop_compile_worker()
     if thisGrammar: thisGrammar.unload()
     thisGrammar = None
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Standalone gaze service.
+
+Owns the eye tracker connection and publishes its samples into a memory-mapped
+ring buffer, so that readers (the SharedMemoryBackend in _eye_tracker_utils, or
+any other local tool) get the latest sample without calling into the tracker
+driver. Run it outside NatLink:
+
+    pythonw gaze_service.py [--trace FILE] [--rate HZ] [--path FILE]
+
+The mapping holds a header followed by capacity records of (timestamp, x, y)
+doubles. The writer fills the slot for sample number count and only then
+publishes count + 1, so a reader takes the newest slot and checks afterwards
+that the writer hasn't lapped it. Readers ask the service to activate or pan by
+incrementing the request counters in the header, holding a lock on their bytes
+in the backing file so that concurrent readers don't lose increments.
+"""
+
+from __future__ import print_function
+
+import argparse
+import mmap
+import os
+import struct
+import tempfile
+import time
+from contextlib import contextmanager
+
+try:
+    import msvcrt
+    fcntl = None
+except ImportError:
+    msvcrt = None
+    import fcntl
+
+MAGIC = b"GAZE"
+VERSION = 1
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), "dragoncode_gaze.bin")
+
+# magic, version, count, capacity, activations, panning steps
+HEADER = struct.Struct("<4sIQIII4x")
+COUNT = struct.Struct("<Q")
+REQUESTS = struct.Struct("<II")
+RECORD = struct.Struct("<ddd")
+COUNT_OFFSET = 8
+REQUESTS_OFFSET = 20
+
+
+class GazeWriter(object):
+    """Creates the ring buffer and publishes samples into it."""
+
+    def __init__(self, path=DEFAULT_PATH, capacity=256):
+        self.capacity = capacity
+        self.count = 0
+        size = HEADER.size + capacity * RECORD.size
+        # Reuse an existing file rather than truncating it, as readers may
+        # still have it mapped.
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            with open(path, "wb") as f:
+                f.write(b"\0" * size)
+        self.file = open(path, "r+b")
+        self.buffer = mmap.mmap(self.file.fileno(), size)
+        HEADER.pack_into(self.buffer, 0, MAGIC, VERSION, 0, capacity, 0, 0)
+
+    def publish(self, timestamp, x, y):
+        RECORD.pack_into(self.buffer,
+                         HEADER.size + (self.count % self.capacity) * RECORD.size,
+                         timestamp, x, y)
+        self.count += 1
+        COUNT.pack_into(self.buffer, COUNT_OFFSET, self.count)
+
+    def requests(self):
+        """Returns the (activations, panning steps) counters."""
+        return REQUESTS.unpack_from(self.buffer, REQUESTS_OFFSET)
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+
+class GazeReader(object):
+    """Reads samples published by a GazeWriter, possibly in another process."""
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.file = open(path, "r+b")
+        self.buffer = mmap.mmap(self.file.fileno(), 0)
+        magic, version, _, self.capacity, _, _ = HEADER.unpack_from(self.buffer)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise IOError("%s is not a version %d gaze buffer" %
+                          (path, VERSION))
+
+    def latest(self):
+        """Returns the newest (timestamp, x, y) sample, or None if nothing has
+        been published."""
+        while True:
+            count = COUNT.unpack_from(self.buffer, COUNT_OFFSET)[0]
+            if not count:
+                return None
+            sample = RECORD.unpack_from(
+                self.buffer,
+                HEADER.size + ((count - 1) % self.capacity) * RECORD.size)
+            lapped = COUNT.unpack_from(self.buffer, COUNT_OFFSET)[0] - count
+            if lapped < self.capacity - 1:
+                return sample
+
+    def request(self, activate=False, panning_step=False):
+        """Asks the service to activate or pan at the current position."""
+        with self._requests_locked():
+            activations, panning_steps = REQUESTS.unpack_from(self.buffer,
+                                                              REQUESTS_OFFSET)
+            REQUESTS.pack_into(self.buffer, REQUESTS_OFFSET,
+                               activations + bool(activate),
+                               panning_steps + bool(panning_step))
+
+    @contextmanager
+    def _requests_locked(self):
+        """Holds an exclusive lock on the request counters' bytes of the
+        backing file, across processes."""
+        fd = self.file.fileno()
+        if msvcrt:
+            self.file.seek(REQUESTS_OFFSET)
+            msvcrt.locking(fd, msvcrt.LK_LOCK, REQUESTS.size)
+        else:
+            fcntl.lockf(fd, fcntl.LOCK_EX, REQUESTS.size, REQUESTS_OFFSET)
+        try:
+            yield
+        finally:
+            if msvcrt:
+                self.file.seek(REQUESTS_OFFSET)
+                msvcrt.locking(fd, msvcrt.LK_UNLCK, REQUESTS.size)
+            else:
+                fcntl.lockf(fd, fcntl.LOCK_UN, REQUESTS.size, REQUESTS_OFFSET)
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+
+def serve(backend, writer, rate):
+    """Polls backend at rate Hz forever, publishing samples to writer and
+    forwarding activation and panning requests to backend."""
+    interval = 1.0 / rate
+    handled = writer.requests()
+    print("connect: %d" % backend.connect())
+    while True:
+        start = time.time()
+        try:
+            x, y = backend.last_position()
+            writer.publish(start, x, y)
+            requests = writer.requests()
+            for _ in range(requests[0] - handled[0]):
+                backend.activate()
+            for _ in range(requests[1] - handled[1]):
+                backend.panning_step()
+            handled = requests
+        except Exception as e:
+            print("Tracker error: %s" % e)
+        time.sleep(max(0, interval - (time.time() - start)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--trace", help="replay this trace instead of "
+                        "connecting to the tracker")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed")
+    parser.add_argument("--rate", type=float, default=60,
+                        help="samples per second")
+    parser.add_argument("--path", default=DEFAULT_PATH,
+                        help="file backing the shared memory")
+    args = parser.parse_args()
+
+    import _eye_tracker_utils as eye_tracker
+    if args.trace:
+        backend = eye_tracker.ReplayBackend(args.trace, args.speed, loop=True)
+    else:
+        backend = eye_tracker.DllBackend()
+    writer = GazeWriter(args.path)
+    try:
+        serve(backend, writer, args.rate)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        backend.disconnect()
+        writer.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# (c) Copyright 2015 by James Stout
+# Licensed under the LGPL, see <http://www.gnu.org/licenses/>
+
+"""Tests for _execution_utils, run against dragonfly's text engine:
+
+    python -m unittest test_execution_utils
+"""
+
+import threading
+import time
+import unittest
+
+from dragonfly import (
+    CompoundRule,
+    Dictation,
+    Function,
+    Grammar,
+    IntegerRef,
+    Key,
+    Mimic,
+    RuleRef,
+    Text,
+    get_engine,
+)
+
+import _dragonfly_utils as utils
+import _execution_utils as execution
+import _metrics_utils as metrics
+
+engine = get_engine("text")
+
+
+class PlanRule(CompoundRule):
+    """Keeps the value of each recognized command, which is the bound action
+    MappingRule.value() returns."""
+
+    spec = "<command>"
+
+    def __init__(self, rule):
+        self.plans = []
+        CompoundRule.__init__(self, extras=[RuleRef(rule, name="command")])
+
+    def _process_recognition(self, node, extras):
+        self.plans.append(extras["command"])
+
+
+class BoundPlanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rule = utils.create_rule("TestCommands", {
+            "slap [<n>]": Key("enter/5:%(n)d"),
+            "mimic <text>": Key("escape") + Mimic(extra="text"),
+            "scroll": utils.EngineFunction(lambda: None),
+            "attack order": utils.Timeline(Key("alt:down"), 120, Key("alt:up")),
+            "say <text>": Text("%(text)s"),
+        }, {
+            "n": (IntegerRef("n", 1, 100), 1),
+            "text": Dictation(),
+        })
+        self.rule = PlanRule(rule)
+        self.grammar = Grammar("TestGrammar")
+        self.grammar.add_rule(self.rule)
+        self.grammar.load()
+
+    def tearDown(self):
+        self.grammar.unload()
+
+    def plan(self, words):
+        engine.mimic(words)
+        return self.rule.plans.pop()
+
+    def test_leaves_of_bound_plan(self):
+        action = self.plan("slap fifty")
+        self.assertFalse(isinstance(action, utils.CommandAction))
+        self.assertEqual([type(leaf) for leaf in execution.leaves(action)], [Key])
+
+    def test_bound_plan_needs_engine_thread(self):
+        self.assertTrue(execution.needs_engine_thread(self.plan("mimic hello")))
+        self.assertTrue(execution.needs_engine_thread(self.plan("scroll")))
+        self.assertFalse(execution.needs_engine_thread(self.plan("slap")))
+
+    def test_bound_plan_budget(self):
+        self.assertAlmostEqual(execution.action_budget(self.plan("slap fifty")),
+                               49 * 0.05 + execution.type_budgets["Key"])
+        self.assertAlmostEqual(execution.action_budget(self.plan("slap")),
+                               execution.type_budgets["Key"])
+        self.assertGreaterEqual(execution.action_budget(self.plan("attack order")),
+                                1.2)
+        self.assertAlmostEqual(execution.action_budget(self.plan("say hello world")),
+                               execution.type_budgets["Text"] +
+                               len("hello world") * (execution.character_budgets["Text"] +
+                                                     Text("")._pause))
+
+    def test_bound_plan_label(self):
+        self.assertEqual(execution.action_label(self.plan("slap fifty")),
+                         "slap [<n>]")
+        self.assertEqual(execution.action_label(Key("a")), str(Key("a")))
+
+    def test_bound_plan_recorded_by_spec(self):
+        latency = metrics.LatencyMetrics()
+        executor = execution.ActionExecutor()
+        executor.submit([self.plan("scroll")], latency.start("TestGrammar"))
+        self.assertEqual(list(latency.commands), ["scroll"])
+
+
+class RecordingKeyboard(object):
+
+    def __init__(self):
+        self.batches = []
+
+    def send_keyboard_events(self, events):
+        self.batches.append(list(events))
+
+
+class InterruptibleKeyboardTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        utils.cancel_check = None
+
+    def test_releases_held_keys_when_cancelled(self):
+        keyboard = RecordingKeyboard()
+        utils.cancel_check = lambda: len(keyboard.batches) > 0
+        self.assertRaises(utils.ActionCancelled,
+                          utils.InterruptibleKeyboard(keyboard).send_keyboard_events,
+                          [("ctrl", True, 0.5), ("a", True, 0), ("a", False, 0),
+                           ("ctrl", False, 0)])
+        self.assertEqual(keyboard.batches, [[("ctrl", True, 0)],
+                                            [("ctrl", False, 0)]])
+
+    def test_sends_all_events(self):
+        keyboard = RecordingKeyboard()
+        utils.InterruptibleKeyboard(keyboard).send_keyboard_events(
+            [("a", True, 0), ("a", False, 0.01), ("b", True, 0), ("b", False, 0)])
+        self.assertEqual(keyboard.batches, [[("a", True, 0), ("a", False, 0)],
+                                            [("b", True, 0), ("b", False, 0)]])
+
+
+class ActionExecutorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = execution.ActionExecutor()
+        self.executor.start()
+
+    def tearDown(self):
+        self.executor.stop()
+
+    def test_engine_plan_does_not_block_submit(self):
+        threads = []
+        self.executor.submit([Function(lambda: time.sleep(0.2))])
+        start = time.time()
+        self.executor.submit([utils.EngineFunction(
+            lambda: threads.append(threading.current_thread()))])
+        self.assertLess(time.time() - start, 0.1)
+        self.executor.plans.join()
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], self.executor.thread)
+
+    def test_engine_plan_runs_inline_when_idle(self):
+        threads = []
+        self.executor.submit([utils.EngineFunction(
+            lambda: threads.append(threading.current_thread()))])
+        self.assertEqual(threads, [threading.current_thread()])
+
+    def test_cancel_stops_running_pause(self):
+        ran = []
+        self.executor.submit([Function(lambda: utils.interruptible_sleep(5)),
+                              Function(lambda: ran.append(True))])
+        time.sleep(0.1)
+        start = time.time()
+        self.executor.cancel()
+        self.executor.plans.join()
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(ran, [])
+        self.assertEqual(self.executor.cancelled, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()